@@ -0,0 +1,300 @@
+################################################################################
+# Forward-model throughput benchmark for the HD 72946 B retrievals. For each   #
+# variant in HD72946B_retrievals.toml, a fixed parameter vector is evaluated   #
+# for scattering on/off and pressure_grid 'standard'/'clouds' with the         #
+# likelihood of species' run_multinest, set up by the pipeline with the        #
+# patches that the manifest enables. MultiNest itself is not run. The bare     #
+# get_model call is also timed for spec_res 50/500. The results are written    #
+# to benchmark.json and compared with a baseline.                              #
+#                                                                              #
+# python HD72946B_benchmark.py                   # run and compare            #
+# python HD72946B_benchmark.py --save-baseline   # store as the baseline      #
+################################################################################
+import argparse
+import contextlib
+import copy
+import datetime
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import species
+
+import HD72946B_models as models
+import HD72946B_pipeline as pipeline
+
+SCATTERING = (True, False)
+PRESSURE_GRID = ('standard', 'clouds')
+SPEC_RES = (50., 500.)
+
+
+def versions():
+    result = {'python': platform.python_version(),
+              'numpy': np.__version__,
+              'species': getattr(species, '__version__', 'unknown')}
+
+    try:
+        import petitRADTRANS
+        result['petitRADTRANS'] = getattr(petitRADTRANS, '__version__', 'unknown')
+
+    except ImportError:
+        result['petitRADTRANS'] = None
+
+    return result
+
+
+def benchmark_parameters(manifest, variant):
+    """
+    Fixed parameter vector of a variant: the shared [benchmark.parameters]
+    of the manifest, updated with ``benchmark_parameters`` of the variant.
+    """
+
+    params = dict(manifest.benchmark.get('parameters', {}))
+    params.update(variant.config.get('benchmark_parameters', {}))
+
+    return params
+
+
+class TimedSampler:
+    """
+    Replacement of ``pymultinest.run`` that times ``n_eval`` calls
+    (after one warm-up call) of the likelihood that ``run_multinest``
+    passes to it, at the fixed parameter vector ``params``, instead of
+    sampling. The parameters are taken in the order of ``params.json``,
+    which ``run_multinest`` writes before it starts MultiNest.
+    """
+
+    def __init__(self, params, n_eval):
+        self.params = params
+        self.n_eval = n_eval
+        self.result = None
+
+    def run(self, LogLikelihood, Prior, n_dims, *args, outputfiles_basename='', **kwargs):
+        with open(os.path.join(os.path.dirname(outputfiles_basename), 'params.json'), encoding='utf-8') as json_file:
+            parameters = json.load(json_file)
+
+        missing = [item for item in parameters if item not in self.params]
+
+        if missing:
+            raise ValueError(f'The benchmark parameters do not include {missing}.')
+
+        cube = np.array([self.params[item] for item in parameters], dtype=float)
+
+        LogLikelihood(cube.copy(), n_dims, n_dims)
+
+        times = np.zeros(self.n_eval)
+
+        for i in range(self.n_eval):
+            start = time.perf_counter()
+            ln_like = LogLikelihood(cube.copy(), n_dims, n_dims)
+            times[i] = time.perf_counter() - start
+
+        self.result = timing(times, ln_like)
+
+
+@contextlib.contextmanager
+def timed_sampler(params, n_eval):
+    import pymultinest
+
+    sampler = TimedSampler(params, n_eval)
+    original = pymultinest.run
+
+    pymultinest.run = sampler.run
+
+    try:
+        yield sampler
+
+    finally:
+        pymultinest.run = original
+
+
+def timing(times, ln_like):
+    return {'rate': float(1./np.mean(times)),
+            'time_mean': float(np.mean(times)),
+            'time_std': float(np.std(times)),
+            'n_eval': times.size,
+            'ln_like': None if ln_like is None else float(ln_like)}
+
+
+def likelihood_case(manifest, variant, params, n_eval, scattering, pressure_grid):
+    """
+    Time the likelihood of ``run_multinest`` for a variant, with the
+    patches that ``pipeline.run_retrieval`` enables for the manifest.
+    The retrieval is set up in a temporary output folder.
+    """
+
+    with tempfile.TemporaryDirectory() as output_folder:
+        config = copy.deepcopy(variant.config)
+        config.update({'scattering': scattering,
+                       'pressure_grid': pressure_grid,
+                       'output_folder': output_folder,
+                       'resume': False})
+        config.pop('warm_start_from', None)
+
+        with timed_sampler(params, n_eval) as sampler:
+            pipeline.run_retrieval(pipeline.Variant(variant.tag, config, variant.object_name), manifest)
+
+    return sampler.result
+
+
+def model_case(read_rad, params, spec_res, n_eval):
+    """
+    Time ``n_eval`` calls of the bare ``get_model`` (after one warm-up
+    call), without the likelihood and the patches.
+    """
+
+    read_rad.get_model(dict(params), spec_res=spec_res)
+
+    times = np.zeros(n_eval)
+
+    for i in range(n_eval):
+        start = time.perf_counter()
+        read_rad.get_model(dict(params), spec_res=spec_res)
+        times[i] = time.perf_counter() - start
+
+    return timing(times, None)
+
+
+def compare(results, baseline, threshold, rtol=1e-6):
+    """
+    Cases of which the evaluation rate dropped by more than
+    ``threshold`` (fraction) with respect to the baseline, or of which
+    the log-likelihood changed by more than ``rtol``.
+    """
+
+    regressions = []
+
+    for case, item in results.items():
+        if case not in baseline:
+            continue
+
+        ratio = item['rate']/baseline[case]['rate']
+
+        print(f'{case}: {item["rate"]:.2f} evaluations/s ({ratio:.2f}x baseline)')
+
+        if ratio < 1.-threshold:
+            regressions.append(case)
+
+        elif item.get('ln_like') is not None and baseline[case].get('ln_like') is not None and \
+                not np.isclose(item['ln_like'], baseline[case]['ln_like'], rtol=rtol, atol=0.):
+            print(f'{case}: ln(L) = {item["ln_like"]} instead of {baseline[case]["ln_like"]}')
+            regressions.append(case)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the forward model of the HD 72946 B retrievals.')
+    parser.add_argument('--tag', action='append', help='only benchmark this variant (can be repeated)')
+    parser.add_argument('--n-eval', type=int, default=None, help='number of timed evaluations per case')
+    parser.add_argument('--output', default='benchmark.json', help='file with the results')
+    parser.add_argument('--baseline', default=None, help='file with the baseline results')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    args = parser.parse_args()
+
+    manifest = pipeline.Manifest()
+
+    settings = manifest.benchmark
+    n_eval = args.n_eval or settings.get('n_eval', 20)
+    baseline_file = args.baseline or settings.get('baseline', 'benchmark_baseline.json')
+    threshold = settings.get('threshold', 0.1)
+
+    species.SpeciesInit()
+
+    database = species.Database()
+
+    objectbox = database.get_object(manifest.object_name, inc_phot=True)
+
+    results = {}
+    done = set()
+
+    for variant in manifest.variants:
+        if args.tag is not None and variant.tag not in args.tag:
+            continue
+
+        config = variant.retrieval_kwargs()
+        params = benchmark_parameters(manifest, variant)
+
+        if config['wavel_range'] == 'data':
+            config['wavel_range'] = models.data_window(objectbox, margin=variant.config.get('window_margin', 4.))
+
+        # Variants that only differ by their priors have the same forward model
+        model_key = hashlib.sha256(json.dumps([config, params], sort_keys=True).encode()).hexdigest()
+
+        if model_key in done:
+            print(f'Skipping {variant.tag}: same forward model as a previous variant')
+            continue
+
+        done.add(model_key)
+
+        for scattering in SCATTERING:
+            for pressure_grid in PRESSURE_GRID:
+                case = f'{variant.tag}/likelihood/scattering={scattering}/pressure_grid={pressure_grid}'
+
+                results[case] = likelihood_case(manifest, variant, params, n_eval, scattering, pressure_grid)
+                results[case].update({'tag': variant.tag,
+                                      'scattering': scattering,
+                                      'pressure_grid': pressure_grid})
+
+                print(f'{case}: {results[case]["rate"]:.2f} evaluations/s')
+
+                read_rad = models.RADTRANS_CACHE.get(line_species=list(config['line_species']),
+                                                     cloud_species=list(config['cloud_species']),
+                                                     scattering=scattering,
+                                                     wavel_range=config['wavel_range'],
+                                                     pressure_grid=pressure_grid,
+                                                     cloud_wavel=config['wavel_range'])
+
+                for spec_res in SPEC_RES:
+                    case = f'{variant.tag}/get_model/scattering={scattering}/pressure_grid={pressure_grid}/spec_res={spec_res:g}'
+
+                    results[case] = model_case(read_rad, params, spec_res, n_eval)
+                    results[case].update({'tag': variant.tag,
+                                          'scattering': scattering,
+                                          'pressure_grid': pressure_grid,
+                                          'spec_res': spec_res})
+
+                    print(f'{case}: {results[case]["rate"]:.2f} evaluations/s')
+
+    output = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'host': platform.node(),
+              'versions': versions(),
+              'results': results}
+
+    with open(args.output, 'w', encoding='utf-8') as json_file:
+        json.dump(output, json_file, indent=4)
+
+    if args.save_baseline:
+        with open(baseline_file, 'w', encoding='utf-8') as json_file:
+            json.dump(output, json_file, indent=4)
+
+        print(f'Stored the results as the baseline in {baseline_file}')
+        return 0
+
+    if not os.path.exists(baseline_file):
+        print(f'No baseline found ({baseline_file}), use --save-baseline to store one')
+        return 0
+
+    with open(baseline_file, encoding='utf-8') as json_file:
+        baseline = json.load(json_file)
+
+    regressions = compare(results, baseline['results'], threshold)
+
+    if regressions:
+        print(f'Slower than the baseline by more than {100.*threshold:.0f}% or a different ln(L):')
+
+        for case in regressions:
+            print(f'  {case}')
+
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+################################################################################
+# Incremental figure builds. Each output of the figures stage is recorded in   #
+# build.json in its folder together with a hash of its inputs: the posterior   #
+# samples, the observations, the model settings and the plot arguments. A      #
+# figure is only recreated if it does not exist or if the hash of its inputs   #
+# has changed. The model spectra are cached separately (ModelCache and the     #
+# derived quantities in the database), so a change of the styling of a        #
+# figure recreates that figure without running the radiative transfer again.   #
+################################################################################
+import hashlib
+import json
+import os
+
+import h5py
+import numpy as np
+
+# File with the input hashes of the outputs in a folder
+BUILD_FILE = 'build.json'
+
+
+def _canonical(value):
+    if isinstance(value, np.ndarray):
+        return hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()+str(value.shape)+str(value.dtype)
+    if isinstance(value, (np.floating, np.integer, np.bool_)):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, dict):
+        return {str(key): _canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    return value
+
+
+def digest(value):
+    """
+    Hash of a (nested) dictionary or list with numbers, strings and
+    arrays. Arrays are hashed by their content.
+    """
+
+    canonical = json.dumps(_canonical(value), sort_keys=True, separators=(',', ':'), default=str)
+
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def group_digest(database_path, path, attrs=True):
+    """
+    Hash of the datasets (and attributes) in a group of an HDF5 file,
+    e.g. ``objects/<name>`` for the observations of an object.
+    """
+
+    content = {}
+
+    def visit(name, item):
+        if isinstance(item, h5py.Dataset):
+            content[name] = np.asarray(item)
+
+        if attrs:
+            content[name+'/attrs'] = dict(item.attrs)
+
+    with h5py.File(database_path, 'r') as h5_file:
+        h5_file[path].visititems(visit)
+
+    return digest(content)
+
+
+class FigureBuild:
+    """
+    Input hashes of the figures in ``folder``. The inputs in ``common``
+    (e.g. the rendering settings) are added to the inputs of every
+    figure. With ``force``, all figures are considered out of date.
+    """
+
+    def __init__(self, folder, force=False, common=None):
+        self.filename = os.path.join(folder, BUILD_FILE)
+        self.force = force
+        self.common = {} if common is None else common
+
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r', encoding='utf-8') as json_file:
+                self.state = json.load(json_file)
+        else:
+            self.state = {}
+
+    def outdated(self, output, inputs):
+        """
+        Check if ``output`` has to be recreated for ``inputs``.
+        """
+
+        return self.force or not os.path.exists(output) or \
+            self.state.get(os.path.basename(output)) != self.digest(inputs)
+
+    def digest(self, inputs):
+        return digest({'inputs': inputs, 'common': self.common})
+
+    def done(self, output, inputs):
+        self.state[os.path.basename(output)] = self.digest(inputs)
+
+        # Write to a temporary file first such that an interrupted run leaves no partial file
+        with open(self.filename+'.tmp', 'w', encoding='utf-8') as json_file:
+            json.dump(self.state, json_file, indent=4, sort_keys=True)
+
+        os.replace(self.filename+'.tmp', self.filename)
+
+    def build(self, output, inputs, func, *args, pool=None, **kwargs):
+        """
+        Call ``func`` if ``output`` is out of date and record the hash of
+        ``inputs`` afterwards (only if ``func`` did not raise). With
+        ``pool`` (a :class:`~HD72946B_render.RenderPool`), ``func`` is
+        rendered by a worker and the hash is recorded when it finishes.
+        Returns ``True`` if the output is recreated.
+        """
+
+        if not self.outdated(output, inputs):
+            print(f'Skipping {output}: the inputs have not changed')
+            return False
+
+        if pool is not None:
+            pool.submit(output, lambda: func(*args, **kwargs),
+                        callback=lambda: self.done(output, inputs))
+
+        else:
+            func(*args, **kwargs)
+            self.done(output, inputs)
+
+        return True
@@ -0,0 +1,273 @@
+################################################################################
+# Regular-grid interpolation of the equilibrium chemistry of petitRADTRANS     #
+# (interpol_abundances), which is called by the likelihood for every sample.   #
+# The table is evaluated once at the nodes of the petitRADTRANS grid in        #
+# (C/O, [Fe/H], T, P) and stored as log10 abundances, after which all layers   #
+# (or a batch of parameter vectors) and all species are interpolated in a      #
+# single vectorized call. The grid is validated against the original function  #
+# before it replaces interpol_abundances in the retrieval. The grid is an      #
+# approximation of the likelihood, so it is opt-in (chemistry_grid = true).    #
+################################################################################
+import configparser
+import contextlib
+import importlib
+import os
+import sys
+import warnings
+
+import numpy as np
+
+from scipy import ndimage
+
+# Modules with interpol_abundances and the grid nodes: that of petitRADTRANS and
+# the standalone package, which species imports instead if it has been imported.
+# Every loaded module that binds one of these functions is patched, including
+# species modules that imported it by name
+SOURCES = ('petitRADTRANS.poor_mans_nonequ_chem.poor_mans_nonequ_chem',
+           'poor_mans_nonequ_chem.poor_mans_nonequ_chem')
+
+# Names of the grid nodes in the petitRADTRANS chemistry module
+NODES = ('COs', 'FEHs', 'temps', 'pressures')
+
+
+def _import(module_name):
+    try:
+        return importlib.import_module(module_name)
+
+    except ImportError:
+        return None
+
+
+def interp_method(config_file='species_config.ini'):
+    """
+    Interpolation method from the species configuration, limited to
+    the methods of the chemistry grid ('linear' and 'cubic').
+    """
+
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    method = config.get('species', 'interp_method', fallback='linear')
+
+    return method if method in ('linear', 'cubic') else 'linear'
+
+
+class ChemistryGrid:
+    """
+    Equilibrium abundances of ``keys`` (all keys that are returned by
+    ``interpol_abundances`` if ``None``) on the grid of petitRADTRANS,
+    interpolated in (C/O, [Fe/H], log10 T, log10 P) with ``method``
+    ('linear' or 'cubic' B-spline). With ``cache_file``, the tabulated grid is
+    stored such that it is only computed once.
+    """
+
+    def __init__(self, func, nodes, keys=None, method='linear', cache_file=None):
+        self.func = func
+        self.method = method
+
+        co_ratio, metallicity, temp, pressure = [np.asarray(item, dtype=float) for item in nodes]
+        self.nodes = (co_ratio, metallicity, np.log10(temp), np.log10(pressure))
+
+        table = None
+        shape = tuple(item.size for item in self.nodes)
+
+        if cache_file is not None and os.path.exists(cache_file):
+            with np.load(cache_file) as npz_file:
+                # The cached table is only used if the grid is unchanged
+                if npz_file['table'].shape[:4] == shape:
+                    self.keys = [str(item) for item in npz_file['keys']]
+                    table = npz_file['table']
+
+        if table is None:
+            table = self.tabulate(co_ratio, metallicity, temp, pressure, keys)
+
+            if cache_file is not None:
+                # Unique temporary file, since MPI ranks can tabulate at the same time
+                tmp_file = cache_file+f'.{os.getpid()}.npz'
+                np.savez(tmp_file, keys=np.array(self.keys), table=table)
+                os.replace(tmp_file, cache_file)
+
+        # Spline coefficients of each key on the index grid, such that the
+        # interpolation is a single map_coordinates call per key
+        self.order = 3 if method == 'cubic' else 1
+
+        if self.order == 1:
+            self.coeffs = [np.ascontiguousarray(table[..., k]) for k in range(len(self.keys))]
+        else:
+            self.coeffs = [ndimage.spline_filter(table[..., k], order=3, mode='nearest', output=np.float32)
+                           for k in range(len(self.keys))]
+
+    def interpolate(self, points):
+        """
+        Log10 abundances at points with the coordinates (C/O, [Fe/H],
+        log10 T, log10 P) and shape (n, 4). The coordinates are mapped
+        to fractional indices of the grid and limited to the grid.
+        """
+
+        coords = np.array([np.interp(points[:, i], item, np.arange(item.size))
+                           for i, item in enumerate(self.nodes)])
+
+        return np.column_stack([ndimage.map_coordinates(item, coords, order=self.order,
+                                                        mode='nearest', prefilter=False)
+                                for item in self.coeffs])
+
+    def tabulate(self, co_ratio, metallicity, temp, pressure, keys):
+        # One call of the original function per (C/O, [Fe/H]) for all (T, P)
+        temp_grid, press_grid = np.meshgrid(temp, pressure, indexing='ij')
+        temp_grid, press_grid = temp_grid.ravel(), press_grid.ravel()
+
+        table = None
+
+        for i, co_item in enumerate(co_ratio):
+            for j, feh_item in enumerate(metallicity):
+                abund = self.func(np.full(temp_grid.size, co_item),
+                                  np.full(temp_grid.size, feh_item),
+                                  temp_grid, press_grid)
+
+                if table is None:
+                    self.keys = list(abund) if keys is None else list(keys)
+                    table = np.zeros((co_ratio.size, metallicity.size, temp.size,
+                                      pressure.size, len(self.keys)), dtype=np.float32)
+
+                for k, key in enumerate(self.keys):
+                    value = np.log10(np.clip(abund[key], 1e-50, None))
+                    table[i, j, :, :, k] = value.reshape(temp.size, pressure.size)
+
+        return table
+
+    def _points(self, co_ratio, metallicity, temp, pressure):
+        temp = np.atleast_2d(temp)
+        n_batch, n_layer = temp.shape
+
+        pressure = np.broadcast_to(pressure, temp.shape)
+        co_ratio = np.broadcast_to(np.reshape(co_ratio, (-1, 1)), temp.shape)
+        metallicity = np.broadcast_to(np.reshape(metallicity, (-1, 1)), temp.shape)
+
+        return np.column_stack([co_ratio.ravel(), metallicity.ravel(),
+                                np.log10(temp).ravel(), np.log10(pressure).ravel()]), (n_batch, n_layer)
+
+    def batch(self, co_ratio, metallicity, temp, pressure):
+        """
+        Abundances for a batch of parameter vectors: ``co_ratio`` and
+        ``metallicity`` with shape (m,), ``temp`` with shape (m, n) and
+        ``pressure`` with shape (n,). Returns a dictionary with arrays
+        with shape (m, n).
+        """
+
+        points, shape = self._points(co_ratio, metallicity, temp, pressure)
+        values = 10.**self.interpolate(points)
+
+        return {key: values[:, k].reshape(shape) for k, key in enumerate(self.keys)}
+
+    def interpol_abundances(self, COs_goal_in, FEHs_goal_in, temps_goal_in, pressures_goal_in,
+                            Pquench_carbon=None):
+        """
+        Replacement of ``interpol_abundances`` with the same arguments.
+        Quenching is computed with the original function.
+        """
+
+        if Pquench_carbon is not None:
+            return self.func(COs_goal_in, FEHs_goal_in, temps_goal_in, pressures_goal_in,
+                             Pquench_carbon=Pquench_carbon)
+
+        points = np.column_stack([COs_goal_in, FEHs_goal_in,
+                                  np.log10(temps_goal_in), np.log10(pressures_goal_in)])
+
+        values = 10.**self.interpolate(points)
+
+        return {key: values[:, k] for k, key in enumerate(self.keys)}
+
+    def validate(self, n_points=1000, seed=None):
+        """
+        Largest difference (dex) with the original function for random
+        points within the grid.
+        """
+
+        rng = np.random.default_rng(seed)
+
+        co_ratio, metallicity, log_temp, log_press = [rng.uniform(item[0], item[-1], n_points)
+                                                      for item in self.nodes]
+
+        original = self.func(co_ratio, metallicity, 10.**log_temp, 10.**log_press)
+        result = self.interpol_abundances(co_ratio, metallicity, 10.**log_temp, 10.**log_press)
+
+        return max(float(np.amax(np.abs(np.log10(np.clip(original[key], 1e-50, None)) -
+                                        np.log10(np.clip(result[key], 1e-50, None)))))
+                   for key in self.keys)
+
+
+def _sources():
+    # The standalone package is only used by species if it is imported already
+    for module_name in SOURCES:
+        if module_name.startswith('petitRADTRANS') or module_name.split('.')[0] in sys.modules:
+            chem = _import(module_name)
+
+            if chem is not None and all(hasattr(chem, item) for item in NODES):
+                yield module_name, chem
+
+
+def _cache_file(cache_file, module_name):
+    if cache_file is None or module_name == SOURCES[0]:
+        return cache_file
+
+    root, ext = os.path.splitext(cache_file)
+
+    return f'{root}_{module_name.split(".")[0]}{ext}'
+
+
+@contextlib.contextmanager
+def chemistry_grid(method=None, cache_file=None, tolerance=0.01):
+    """
+    Use the chemistry grid for the retrievals that run inside the
+    ``with`` block, if its largest difference with the original
+    function is smaller than ``tolerance`` (dex). A grid is made for
+    each chemistry module that species can use.
+    """
+
+    if method is None:
+        method = interp_method()
+
+    grids = {}
+
+    for module_name, chem in _sources():
+        grid = ChemistryGrid(chem.interpol_abundances,
+                             [getattr(chem, item) for item in NODES],
+                             method=method, cache_file=_cache_file(cache_file, module_name))
+
+        deviation = grid.validate(seed=0)
+
+        print(f'Chemistry grid of {module_name} ({method}): largest difference with '
+              f'interpol_abundances = {deviation:.2e} dex')
+
+        if deviation > tolerance:
+            warnings.warn(f'The chemistry grid of {module_name} deviates by more than {tolerance} dex, '
+                          f'so its interpol_abundances is used.')
+            continue
+
+        grids[id(grid.func)] = grid
+
+    if not grids:
+        warnings.warn('No chemistry grid is used, so interpol_abundances is used.')
+        yield None
+        return
+
+    patched = []
+
+    for module in list(sys.modules.values()):
+        try:
+            func = getattr(module, 'interpol_abundances', None)
+
+        except Exception:
+            # Modules with a lazy __getattr__ can raise other errors
+            continue
+
+        if id(func) in grids and grids[id(func)].func is func:
+            patched.append((module, func))
+            module.interpol_abundances = grids[id(func)].interpol_abundances
+
+    try:
+        yield list(grids.values())
+
+    finally:
+        for module, func in reversed(patched):
+            module.interpol_abundances = func
@@ -0,0 +1,385 @@
+################################################################################
+# Covariance engine for the correlated noise of a spectrum (fit_corr), with    #
+# the kernel of Wang et al. (2020) as used by AtmosphericRetrieval:            #
+#                                                                              #
+#   C_ij = a^2 s_i s_j exp(-(l_i-l_j)^2/(2 L^2)) + (1-a^2) s_i^2 delta_ij       #
+#                                                                              #
+# The wavelength distances are computed once per spectrum, and the Cholesky   #
+# factorization is cached for the last correlation parameters. Since the      #
+# kernel decays as a Gaussian, the factorization is banded when the            #
+# correlation length is small compared to the wavelength range (e.g. GRAVITY),#
+# which reduces the cost from O(n^3) to O(n b^2) for a bandwidth b.            #
+# retrieval_covariance gives the likelihood of run_multinest the inverse of    #
+# this matrix as the cached factorization instead of np.linalg.inv.            #
+################################################################################
+import collections
+import contextlib
+import functools
+import importlib
+import warnings
+
+import numpy as np
+
+from scipy import linalg
+
+
+class CorrelatedNoise:
+    """
+    Correlated-noise covariance of one spectrum with the uncertainties
+    ``error``. The correlation length ``corr_len`` is in the units of
+    ``wavelength`` (um) and ``corr_amp`` is the fractional amplitude.
+    Kernel values below ``tol`` are dropped, which is exact to machine
+    precision for ``tol=1e-16``. Up to ``max_cache`` factorizations are
+    kept, such that repeated parameters are not factorized again.
+    """
+
+    def __init__(self, wavelength, error, tol=1e-16, max_cache=8):
+        wavelength = np.asarray(wavelength, dtype=float)
+
+        # Sorted wavelengths such that the truncated kernel is banded
+        self.order = np.argsort(wavelength)
+        self.wavelength = wavelength[self.order]
+        self.error = np.asarray(error, dtype=float)[self.order]
+        self.size = self.wavelength.size
+
+        # Distance (in units of corr_len) at which the kernel drops below tol
+        self.cutoff = np.sqrt(-2.*np.log(tol))
+
+        self.max_cache = max_cache
+        self.factors = collections.OrderedDict()
+
+    @functools.cached_property
+    def dist_sq(self):
+        return (self.wavelength[:, np.newaxis]-self.wavelength[np.newaxis, :])**2
+
+    @functools.cached_property
+    def error_sq(self):
+        return np.outer(self.error, self.error)
+
+    def matrix(self, corr_len, corr_amp):
+        """
+        Covariance matrix in the order of the input wavelengths.
+        """
+
+        cov = corr_amp**2*self.error_sq*np.exp(-self.dist_sq/(2.*corr_len**2))
+        cov[np.diag_indices(self.size)] += (1.-corr_amp**2)*self.error**2
+
+        inverse = np.argsort(self.order)
+
+        return cov[np.ix_(inverse, inverse)]
+
+    def bandwidth(self, corr_len):
+        index = np.searchsorted(self.wavelength, self.wavelength+self.cutoff*corr_len, side='right')
+        return int(np.amax(index-np.arange(self.size)))-1
+
+    def band(self, corr_len, corr_amp, n_band):
+        """
+        Upper banded storage of the sorted covariance matrix with
+        ``n_band`` off-diagonals: ``ab[n_band+i-j, j] = C[i, j]``.
+        """
+
+        ab = np.zeros((n_band+1, self.size))
+
+        for k in range(n_band+1):
+            diag = corr_amp**2*self.error[:self.size-k]*self.error[k:] * \
+                np.exp(-(self.wavelength[k:]-self.wavelength[:self.size-k])**2/(2.*corr_len**2))
+
+            if k == 0:
+                diag = diag + (1.-corr_amp**2)*self.error**2
+
+            ab[n_band-k, k:] = diag
+
+        return ab
+
+    def matches(self, matrix, corr_len, corr_amp, rtol=1e-8):
+        """
+        Check if ``matrix`` (in the order of the input wavelengths) is
+        the covariance matrix for the correlation parameters, on the band
+        that the factorization uses.
+        """
+
+        atol = 1e-12*np.amax(self.error)**2
+        n_band = self.bandwidth(corr_len)
+
+        if 2*n_band >= self.size:
+            return np.allclose(self.matrix(corr_len, corr_amp), matrix, rtol=rtol, atol=atol)
+
+        ab = self.band(corr_len, corr_amp, n_band)
+
+        for k in range(n_band+1):
+            if not np.allclose(matrix[self.order[:self.size-k], self.order[k:]], ab[n_band-k, k:],
+                               rtol=rtol, atol=atol):
+                return False
+
+        return True
+
+    def factor(self, corr_len, corr_amp):
+        """
+        Cholesky factorization for the correlation parameters, as
+        ``(banded, factor, ln_det)``. The result is cached.
+        """
+
+        key = (float(corr_len), float(corr_amp))
+
+        if key in self.factors:
+            self.factors.move_to_end(key)
+            return self.factors[key]
+
+        n_band = self.bandwidth(corr_len)
+
+        if 2*n_band < self.size:
+            ab = self.band(corr_len, corr_amp, n_band)
+            chol = linalg.cholesky_banded(ab)
+            result = (True, chol, 2.*np.sum(np.log(chol[-1])))
+
+        else:
+            cov = corr_amp**2*self.error_sq*np.exp(-self.dist_sq/(2.*corr_len**2))
+            cov[np.diag_indices(self.size)] += (1.-corr_amp**2)*self.error**2
+
+            chol = linalg.cho_factor(cov)
+            result = (False, chol, 2.*np.sum(np.log(np.diag(chol[0]))))
+
+        self.factors[key] = result
+
+        if len(self.factors) > self.max_cache:
+            self.factors.popitem(last=False)
+
+        return result
+
+    def solve(self, residual, corr_len, corr_amp):
+        """
+        C^-1 r for a residual (n,) or a set of residuals (n, m), in the
+        order of the input wavelengths.
+        """
+
+        banded, chol, _ = self.factor(corr_len, corr_amp)
+
+        residual = np.asarray(residual, dtype=float)[self.order]
+
+        if banded:
+            solution = linalg.cho_solve_banded((chol, False), residual)
+        else:
+            solution = linalg.cho_solve(chol, residual)
+
+        result = np.empty_like(solution)
+        result[self.order] = solution
+
+        return result
+
+    def chi_square(self, residual, corr_len, corr_amp):
+        """
+        r^T C^-1 r, as computed with the inverse covariance matrix in
+        the likelihood of ``run_multinest``.
+        """
+
+        residual = np.asarray(residual, dtype=float)
+
+        return float(residual @ self.solve(residual, corr_len, corr_amp))
+
+    def ln_det(self, corr_len, corr_amp):
+        return self.factor(corr_len, corr_amp)[2]
+
+    def chi_square_batch(self, residuals, corr_len, corr_amp):
+        """
+        r^T C^-1 r for a batch of residuals with shape (m, n) and
+        correlation parameters with shape (m,). Residuals with the same
+        parameters are solved with one factorization.
+        """
+
+        residuals = np.atleast_2d(np.asarray(residuals, dtype=float))
+        params = np.column_stack([np.broadcast_to(corr_len, residuals.shape[0]),
+                                  np.broadcast_to(corr_amp, residuals.shape[0])])
+
+        chi_sq = np.zeros(residuals.shape[0])
+
+        unique, inverse = np.unique(params, axis=0, return_inverse=True)
+
+        for i, item in enumerate(unique):
+            indices = np.flatnonzero(inverse.ravel() == i)
+            solution = self.solve(residuals[indices].T, item[0], item[1])
+            chi_sq[indices] = np.sum(residuals[indices].T*solution, axis=0)
+
+        return chi_sq
+
+
+def _import(module_name):
+    try:
+        return importlib.import_module(module_name)
+
+    except ImportError:
+        return None
+
+
+class _Inverse:
+    """
+    Inverse of a covariance matrix from its Cholesky factorization,
+    which ``dot`` (also through ``np.dot``) applies to a residual
+    without forming the matrix.
+    """
+
+    def __init__(self, noise, corr_len, corr_amp):
+        self.noise = noise
+        self.params = (corr_len, corr_amp)
+        self.shape = (noise.size, noise.size)
+
+    def dot(self, other):
+        return self.noise.solve(other, *self.params)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.dot(np.eye(self.noise.size)), dtype=dtype)
+
+    def __array_function__(self, func, types, args, kwargs):
+        if func is np.dot and len(args) == 2 and args[0] is self and not kwargs:
+            return self.dot(args[1])
+
+        return func(*[np.asarray(item) if item is self else item for item in args], **kwargs)
+
+
+class RetrievalCovariance:
+    """
+    Correlated-noise term of the spectra in ``fit_corr`` in the
+    likelihood of ``run_multinest`` of ``retrieve`` (an
+    ``AtmosphericRetrieval``). The likelihood function that is passed
+    to ``pymultinest.run`` is wrapped: for each call, the correlation
+    length and amplitude are read from the parameter cube and the
+    spectrum is given the inverse covariance matrix as an
+    :class:`_Inverse` of the cached Cholesky factorization of
+    :class:`CorrelatedNoise`. ``run_multinest`` then takes its branch
+    for a spectrum with an inverted covariance matrix, which computes
+    the same chi2 and normalization as its ``fit_corr`` branch, with
+    ``np.dot`` solving with the factorization instead of
+    ``np.linalg.inv``. The first chi2 of each spectrum is compared with
+    ``np.linalg.inv`` (relative tolerance ``rtol``). Spectra with less
+    than ``min_size`` points (for which ``np.linalg.inv`` is faster),
+    with their own covariance matrix, with an error inflation parameter
+    or in ``cross_corr`` are left to ``run_multinest``.
+    """
+
+    def __init__(self, retrieve, fit_corr, min_size=100, rtol=1e-6):
+        self.retrieve = retrieve
+        self.rtol = rtol
+
+        self.noise = {}
+
+        for name in fit_corr:
+            spectrum = retrieve.spectrum.get(name)
+
+            if spectrum is None or spectrum[0].shape[0] < min_size or spectrum[1] is not None:
+                continue
+
+            self.noise[name] = CorrelatedNoise(spectrum[0][:, 0], spectrum[0][:, 2])
+
+        self.checked = {}
+        self.patched = []
+
+        self.solved = 0
+
+    def check(self, name, noise, corr_len, corr_amp):
+        residual = noise.error*np.random.default_rng(0).standard_normal(noise.size)
+        residual = residual[np.argsort(noise.order)]
+
+        expected = residual @ np.linalg.inv(noise.matrix(corr_len, corr_amp)) @ residual
+        chi_sq = noise.chi_square(residual, corr_len, corr_amp)
+
+        if not np.isclose(chi_sq, expected, rtol=self.rtol, atol=0.):
+            warnings.warn(f'The Cholesky chi2 of {name} ({chi_sq}) differs from the chi2 with '
+                          f'np.linalg.inv ({expected}), so np.linalg.inv is used.')
+            return False
+
+        return True
+
+    def spectra(self, cube):
+        """
+        Spectra of ``retrieve`` for the parameter cube, with the inverse
+        covariance matrix of the spectra that are solved here.
+        """
+
+        parameters = self.retrieve.parameters
+        spectra = {}
+
+        for name, noise in self.noise.items():
+            if f'corr_len_{name}' not in parameters or f'corr_amp_{name}' not in parameters or \
+                    f'error_{name}' in parameters or name in getattr(self.retrieve, 'cross_corr', []):
+                continue
+
+            corr_len = 10.**cube[parameters.index(f'corr_len_{name}')]
+            corr_amp = cube[parameters.index(f'corr_amp_{name}')]
+
+            if name not in self.checked:
+                self.checked[name] = self.check(name, noise, corr_len, corr_amp)
+
+            if self.checked[name]:
+                spectrum = self.retrieve.spectrum[name]
+                spectra[name] = type(spectrum)([spectrum[0], spectrum[1], _Inverse(noise, corr_len, corr_amp)]
+                                               + list(spectrum[3:]))
+
+        return spectra
+
+    def likelihood(self, loglike):
+        """
+        Wrap the likelihood function of ``run_multinest``.
+        """
+
+        def wrapper(cube, n_dim, n_param):
+            spectra = self.spectra(cube)
+            original = {name: self.retrieve.spectrum[name] for name in spectra}
+
+            self.retrieve.spectrum.update(spectra)
+            self.solved += len(spectra)
+
+            try:
+                return loglike(cube, n_dim, n_param)
+
+            finally:
+                self.retrieve.spectrum.update(original)
+
+        return wrapper
+
+    def install(self):
+        """
+        Wrap the likelihood function that ``run_multinest`` passes to
+        ``pymultinest.run``.
+        """
+
+        pymultinest = _import('pymultinest')
+
+        if pymultinest is None or not self.noise:
+            return
+
+        original = pymultinest.run
+
+        def run(LogLikelihood, Prior, n_dims, *args, **kwargs):
+            return original(self.likelihood(LogLikelihood), Prior, n_dims, *args, **kwargs)
+
+        self.patched.append((pymultinest, 'run', original))
+        pymultinest.run = run
+
+    def uninstall(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+
+        self.patched = []
+
+    def report(self):
+        if self.solved > 0:
+            print(f'Correlated noise: {self.solved} chi2 evaluations of {", ".join(self.noise)} '
+                  f'from the cached Cholesky factorization')
+
+
+@contextlib.contextmanager
+def retrieval_covariance(retrieve, fit_corr, min_size=100, rtol=1e-6):
+    """
+    Compute the correlated-noise term of the spectra in ``fit_corr``
+    with :class:`CorrelatedNoise` in the retrieval of ``retrieve``
+    that runs inside the ``with`` block.
+    """
+
+    covariance = RetrievalCovariance(retrieve, fit_corr, min_size=min_size, rtol=rtol)
+    covariance.install()
+
+    try:
+        yield covariance
+
+    finally:
+        covariance.uninstall()
+        covariance.report()
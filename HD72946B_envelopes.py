@@ -0,0 +1,246 @@
+################################################################################
+# Streaming credible envelopes of posterior spectra. Instead of keeping the    #
+# spectrum of every drawn sample and overlaying them in the spectrum figure,   #
+# the spectra are generated in chunks and passed through running estimators    #
+# of the mean and of the median and 1 sigma / 2 sigma quantiles at each        #
+# wavelength. The 'sketch' method uses the extended P^2 algorithm (Jain &      #
+# Chlamtac 1985; Raatikainen 1987), which keeps 2m+3 markers per wavelength    #
+# for m quantiles, so the memory does not depend on the number of samples.     #
+# The 'exact' method keeps all spectra (float32) and is meant for validation.  #
+################################################################################
+import contextlib
+
+import numpy as np
+
+from species.core import box
+
+# Median and the 1 sigma / 2 sigma intervals of a normal distribution
+QUANTILES = (0.02275, 0.15865, 0.5, 0.84135, 0.97725)
+
+
+class P2Quantiles:
+    """
+    Extended P^2 estimator of ``quantiles`` for a stream of vectors with
+    ``size`` elements (one estimate per element).
+    """
+
+    def __init__(self, size, quantiles=QUANTILES):
+        self.quantiles = np.asarray(quantiles, dtype=float)
+
+        # Marker probabilities: 0, the quantiles, the midpoints between them, 1
+        edges = np.concatenate([[0.], self.quantiles, [1.]])
+        self.prob = np.sort(np.concatenate([edges, 0.5*(edges[1:]+edges[:-1])]))
+
+        self.n_markers = self.prob.size
+        self.index = np.searchsorted(self.prob, self.quantiles)
+
+        self.heights = np.zeros((self.n_markers, size))
+        self.positions = np.tile(np.arange(1., self.n_markers+1.)[:, np.newaxis], (1, size))
+        self.count = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+
+        if self.count < self.n_markers:
+            self.heights[self.count] = values
+            self.count += 1
+
+            if self.count == self.n_markers:
+                self.heights.sort(axis=0)
+
+            return
+
+        self.count += 1
+
+        heights, positions = self.heights, self.positions
+
+        # Cell of each value, extending the extreme markers if required
+        np.minimum(heights[0], values, out=heights[0])
+        np.maximum(heights[-1], values, out=heights[-1])
+
+        cell = np.clip(np.sum(values >= heights[1:-1], axis=0), 0, self.n_markers-2)
+        positions += np.arange(self.n_markers)[:, np.newaxis] > cell
+
+        desired = 1.+self.prob*(self.count-1.)
+
+        for i in range(1, self.n_markers-1):
+            diff = desired[i]-positions[i]
+            step_up = positions[i+1]-positions[i]
+            step_down = positions[i-1]-positions[i]
+
+            adjust = ((diff >= 1.) & (step_up > 1.)) | ((diff <= -1.) & (step_down < -1.))
+
+            if not np.any(adjust):
+                continue
+
+            sign = np.where(diff >= 0., 1., -1.)[adjust]
+
+            h_prev, h_cur, h_next = heights[i-1, adjust], heights[i, adjust], heights[i+1, adjust]
+            n_prev, n_cur, n_next = positions[i-1, adjust], positions[i, adjust], positions[i+1, adjust]
+
+            # Piecewise-parabolic prediction, or linear if it is not monotonic
+            parabolic = h_cur+sign/(n_next-n_prev)*((n_cur-n_prev+sign)*(h_next-h_cur)/(n_next-n_cur) +
+                                                    (n_next-n_cur-sign)*(h_cur-h_prev)/(n_cur-n_prev))
+
+            linear = np.where(sign > 0., h_cur+(h_next-h_cur)/(n_next-n_cur),
+                              h_cur-(h_prev-h_cur)/(n_prev-n_cur))
+
+            heights[i, adjust] = np.where((h_prev < parabolic) & (parabolic < h_next), parabolic, linear)
+            positions[i, adjust] += sign
+
+    def result(self):
+        """
+        Quantile estimates with shape (n_quantiles, size).
+        """
+
+        if self.count < self.n_markers:
+            # Too few values for the markers, so the quantiles are exact
+            return np.quantile(self.heights[:self.count], self.quantiles, axis=0)
+
+        return self.heights[self.index].copy()
+
+
+class Envelope:
+    """
+    Mean, median and 1 sigma / 2 sigma envelopes of ``n_samples``
+    spectra.
+    """
+
+    def __init__(self, wavelength, mean, quantiles, n_samples):
+        self.wavelength = wavelength
+        self.mean = mean
+        self.lower_2sigma, self.lower_1sigma, self.median, self.upper_1sigma, self.upper_2sigma = quantiles
+        self.n_samples = n_samples
+
+    def boxes(self):
+        """
+        ``ModelBox`` objects of the envelope (2 sigma and 1 sigma lower
+        limit, median, 1 sigma and 2 sigma upper limit), in the order
+        that is expected by :func:`fill_envelopes`.
+        """
+
+        boxes = []
+
+        for flux in (self.lower_2sigma, self.lower_1sigma, self.median, self.upper_1sigma, self.upper_2sigma):
+            model_box = box.create_box(boxtype='model',
+                                       model='petitradtrans',
+                                       wavelength=self.wavelength,
+                                       flux=flux,
+                                       parameters=None,
+                                       quantity='flux',
+                                       contribution=None,
+                                       bol_flux=None)
+
+            # Plotted as posterior samples, i.e. without a legend entry
+            model_box.type = 'mcmc'
+
+            boxes.append(model_box)
+
+        return boxes
+
+
+class EnvelopeEstimator:
+    """
+    Running mean and quantiles of spectra on a common wavelength grid,
+    with ``method`` 'sketch' (P^2, constant memory) or 'exact' (all
+    spectra are kept).
+    """
+
+    def __init__(self, wavelength, method='sketch'):
+        if method not in ('sketch', 'exact'):
+            raise ValueError(f'The envelope method should be \'sketch\' or \'exact\', not \'{method}\'.')
+
+        self.wavelength = np.asarray(wavelength)
+        self.method = method
+
+        self.count = 0
+        self.total = np.zeros(self.wavelength.size)
+
+        if method == 'sketch':
+            self.sketch = P2Quantiles(self.wavelength.size)
+        else:
+            self.spectra = []
+
+    def update(self, flux):
+        """
+        Add a spectrum (n,) or a chunk of spectra (m, n).
+        """
+
+        flux = np.atleast_2d(flux)
+
+        if flux.shape[1] != self.wavelength.size:
+            raise ValueError('The spectra do not have the wavelengths of the envelope.')
+
+        self.count += flux.shape[0]
+        self.total += np.sum(flux, axis=0)
+
+        if self.method == 'sketch':
+            for item in flux:
+                self.sketch.update(item)
+        else:
+            self.spectra.append(flux.astype(np.float32))
+
+    def result(self):
+        if self.count == 0:
+            raise ValueError('The envelope requires at least one spectrum.')
+
+        if self.method == 'sketch':
+            quantiles = self.sketch.result()
+        else:
+            quantiles = np.quantile(np.concatenate(self.spectra), QUANTILES, axis=0)
+
+        return Envelope(self.wavelength, self.total/self.count, quantiles, self.count)
+
+
+# Marks the lines of the envelope boxes in the spectrum figure
+ENVELOPE_GID = 'posterior_envelope'
+
+
+def envelope_kwargs(color='gray'):
+    """
+    Plot settings for the boxes of :meth:`Envelope.boxes` in
+    ``species.plot_spectrum``.
+    """
+
+    return {'zorder': 2, 'ls': '-', 'lw': 0.5, 'color': color, 'gid': ENVELOPE_GID}
+
+
+@contextlib.contextmanager
+def fill_envelopes(color='gray', alpha=(0.4, 0.2)):
+    """
+    Shade the 1 sigma and 2 sigma envelopes of the figures that are
+    saved inside the ``with`` block (e.g. by ``species.plot_spectrum``),
+    between the lines that are plotted with :func:`envelope_kwargs`.
+    Only the median is kept as line.
+    """
+
+    from matplotlib import figure
+
+    original = figure.Figure.savefig
+
+    def savefig(self, *args, **kwargs):
+        for ax in self.axes:
+            lines = [item for item in ax.get_lines() if item.get_gid() == ENVELOPE_GID]
+
+            for i in range(0, len(lines)-4, 5):
+                lower_2, lower_1, median, upper_1, upper_2 = lines[i:i+5]
+                wavelength = lower_2.get_xdata()
+
+                ax.fill_between(wavelength, lower_2.get_ydata(), upper_2.get_ydata(),
+                                color=color, alpha=alpha[1], lw=0., zorder=median.get_zorder()-0.1)
+
+                ax.fill_between(wavelength, lower_1.get_ydata(), upper_1.get_ydata(),
+                                color=color, alpha=alpha[0], lw=0., zorder=median.get_zorder()-0.1)
+
+                for item in (lower_2, lower_1, upper_1, upper_2):
+                    item.remove()
+
+        return original(self, *args, **kwargs)
+
+    figure.Figure.savefig = savefig
+
+    try:
+        yield
+
+    finally:
+        figure.Figure.savefig = original
@@ -0,0 +1,137 @@
+################################################################################
+# Idempotent ingestion of the observations into the species database. Each    #
+# item (parallax, photometry file, spectrum with covariance and resolution)    #
+# is hashed together with its parameters, and the hashes are stored with the  #
+# object. Items whose hash has not changed are skipped, and only the changed   #
+# items are deleted and added again with species.Database.add_object, which    #
+# parses the files and stores the spectra, covariances and inverted            #
+# covariances in the binary form that the retrieval reads.                     #
+################################################################################
+import hashlib
+import json
+import os
+
+import h5py
+import pandas as pd
+
+# Attribute of objects/<name> with the hashes of the ingested items
+INGESTION_ATTR = 'ingestion'
+
+
+def file_digest(*items):
+    """
+    Hash of the content of files (``None`` is skipped) and of
+    parameters (numbers, strings, tuples).
+    """
+
+    sha = hashlib.sha256()
+
+    for item in items:
+        if isinstance(item, str) and os.path.isfile(item):
+            with open(item, 'rb') as open_file:
+                for block in iter(lambda: open_file.read(1 << 20), b''):
+                    sha.update(block)
+
+        else:
+            sha.update(json.dumps(item).encode('utf-8'))
+
+        sha.update(b'\0')
+
+    return sha.hexdigest()
+
+
+def read_photometry(filename, filters):
+    """
+    Flux densities (W m-2 um-1) with uncertainties for ``filters``, in
+    the order of the rows of a tab-separated file with wavelength, flux
+    and uncertainty.
+    """
+
+    phot = pd.read_csv(filename, sep='\t', names=['l', 'f', 'fe'])
+
+    return {item: (phot['f'][i], phot['fe'][i]) for i, item in enumerate(filters)}
+
+
+def _stored_hashes(database_path, object_name):
+    with h5py.File(database_path, 'r') as h5_file:
+        if f'objects/{object_name}' not in h5_file:
+            return None
+
+        value = h5_file[f'objects/{object_name}'].attrs.get(INGESTION_ATTR, None)
+
+    return None if value is None else json.loads(value)
+
+
+def _delete(database, path):
+    with h5py.File(database.database, 'r') as h5_file:
+        exists = path in h5_file
+
+    if exists:
+        database.delete_data(path)
+
+
+def add_object(database, object_name, parallax=None, photometry=None, spectrum=None, force=False):
+    """
+    Add the observations of an object to the database, skipping the
+    items that have not changed since the last ingestion.
+    ``photometry`` is a tuple with the file and the filter names of its
+    rows, and ``spectrum`` is a dictionary as in
+    ``species.Database.add_object``. Returns the names of the items
+    that were added.
+    """
+
+    hashes = {}
+
+    if parallax is not None:
+        hashes['parallax'] = file_digest(list(parallax))
+
+    if photometry is not None:
+        hashes['photometry'] = file_digest(photometry[0], list(photometry[1]))
+
+    for key, (spec_file, cov_file, spec_res) in (spectrum or {}).items():
+        hashes[f'spectrum/{key}'] = file_digest(spec_file, cov_file, spec_res)
+
+    stored = None if force else _stored_hashes(database.database, object_name)
+
+    if stored is None:
+        # Unknown state (e.g. ingested by an older version), so all items are added again
+        _delete(database, f'objects/{object_name}')
+        changed = list(hashes)
+
+    else:
+        changed = [item for item, value in hashes.items() if stored.get(item) != value]
+
+    if not changed:
+        print(f'The observations of {object_name} have not changed.')
+        return []
+
+    kwargs = {}
+
+    if 'parallax' in changed:
+        _delete(database, f'objects/{object_name}/parallax')
+        kwargs['parallax'] = parallax
+
+    if 'photometry' in changed:
+        for item in photometry[1]:
+            _delete(database, f'objects/{object_name}/{item}')
+
+        kwargs['flux_density'] = read_photometry(*photometry)
+
+    spec_changed = {key: value for key, value in (spectrum or {}).items() if f'spectrum/{key}' in changed}
+
+    if spec_changed:
+        for key in spec_changed:
+            _delete(database, f'objects/{object_name}/spectrum/{key}')
+
+        kwargs['spectrum'] = spec_changed
+
+    print(f'Adding {", ".join(changed)} of {object_name}')
+
+    database.add_object(object_name, **kwargs)
+
+    # The hashes are only stored after the data were added successfully
+    with h5py.File(database.database, 'a') as h5_file:
+        group = h5_file[f'objects/{object_name}']
+        group.attrs[INGESTION_ATTR] = json.dumps(hashes if stored is None else {**stored, **hashes})
+
+    return changed
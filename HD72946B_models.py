@@ -0,0 +1,1022 @@
+################################################################################
+# Model evaluation for the figures stage. All variants share the same line     #
+# and cloud species, wavelength range and pressure grid, so the Radtrans       #
+# instances (and the opacities that they load) are kept in an LRU cache that   #
+# is shared across tags instead of being rebuilt for every call of             #
+# database.get_retrieval_spectra. Model spectra are memoized on a hash of     #
+# the parameters, so the best-fit model is only computed once per tag, and    #
+# posterior samples are evaluated in batches on a pool of worker processes.    #
+# Teff and the posterior spectra of the figures are derived from one pass over #
+# the same samples, which is stored in the database, as is the emission        #
+# contribution function of the best-fit model, which is only computed on       #
+# request.                                                                     #
+################################################################################
+import collections
+import contextlib
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
+
+import h5py
+import numpy as np
+
+from scipy.integrate import trapezoid
+from species.core import box, constants
+from species.read import read_filter, read_radtrans
+from species.util import data_util, retrieval_util
+
+import HD72946B_envelopes as envelopes
+import HD72946B_storage as storage
+
+
+class RetrievalSetup:
+    """
+    Settings of a retrieval that are stored as attributes of
+    ``results/fit/<tag>/samples``, parsed in the same way as in
+    ``species.Database.get_retrieval_spectra``.
+    """
+
+    def __init__(self, database_path, tag):
+        with h5py.File(database_path, 'r') as h5_file:
+            dset = h5_file[f'results/fit/{tag}/samples']
+            attrs = dict(dset.attrs)
+            self.n_samples = dset.shape[0]
+
+        self.tag = tag
+        self.attrs = attrs
+
+        n_param = attrs['n_param'] if 'n_param' in attrs else attrs['nparam']
+        self.parameters = np.asarray([attrs[f'parameter{i}'] for i in range(n_param)])
+        self.indices = {item: np.argwhere(self.parameters == item)[0][0] for item in self.parameters}
+
+        self.line_species = [attrs[f'line_species{i}'] for i in range(attrs['n_line_species'])]
+        self.cloud_species = [attrs[f'cloud_species{i}'] for i in range(attrs['n_cloud_species'])]
+
+        self.scattering = bool(attrs['scattering'])
+        self.chemistry = attrs['chemistry']
+        self.quenching = None if attrs['quenching'] == 'None' else attrs['quenching']
+        self.pt_profile = attrs['pt_profile']
+        self.pressure_grid = attrs.get('pressure_grid', 'smaller')
+        self.temp_nodes = _optional(attrs.get('temp_nodes', 'None'))
+        self.abund_nodes = _optional(attrs.get('abund_nodes', 'None'))
+        self.abund_smooth = _optional(attrs.get('abund_smooth', 'None'))
+        self.max_press = attrs.get('max_press', None)
+        self.res_mode = attrs.get('res_mode', 'c-k')
+        self.lbl_opacity_sampling = _optional(attrs.get('lbl_opacity_sampling', 'None'))
+        self.wavel_range = (attrs['wavel_min'], attrs['wavel_max'])
+
+        if 'parallax' in attrs:
+            self.distance = 1e3/attrs['parallax'][0]
+        else:
+            self.distance = attrs.get('distance', None)
+
+    def radtrans_kwargs(self, wavel_range=None):
+        """
+        Arguments of ``ReadRadtrans`` for this retrieval. The range for
+        the median cloud optical depth is the retrieval range if
+        ``log_tau_cloud`` was fitted, as in ``get_retrieval_spectra``.
+        """
+
+        if 'log_tau_cloud' in self.parameters and wavel_range is not None:
+            cloud_wavel = self.wavel_range
+        else:
+            cloud_wavel = None
+
+        if wavel_range is None:
+            wavel_range = self.wavel_range
+
+        return {'line_species': list(self.line_species),
+                'cloud_species': list(self.cloud_species),
+                'scattering': self.scattering,
+                'wavel_range': tuple(float(item) for item in wavel_range),
+                'pressure_grid': self.pressure_grid,
+                'cloud_wavel': None if cloud_wavel is None else tuple(float(item) for item in cloud_wavel),
+                'max_press': self.max_press,
+                'res_mode': self.res_mode,
+                'lbl_opacity_sampling': self.lbl_opacity_sampling}
+
+    def pt_smooth(self, sample):
+        if 'pt_smooth' in self.attrs:
+            return self.attrs['pt_smooth']
+
+        if 'pt_smooth_0' in self.parameters:
+            return {f'pt_smooth_{j}': sample[-1*self.temp_nodes+j] for j in range(self.temp_nodes-1)}
+
+        return sample[self.indices['pt_smooth']]
+
+
+def _optional(value):
+    # species stores None as the string 'None' in the HDF5 attributes
+    if isinstance(value, str) and value == 'None':
+        return None
+    return value
+
+
+def radtrans_nbytes(read_rad):
+    """
+    Approximate memory footprint (bytes) of a ``ReadRadtrans`` instance,
+    counting the arrays that are attributes of the instance and of its
+    ``Radtrans`` object (including arrays stored in dictionaries, such
+    as the line and cloud opacity tables).
+    """
+
+    total = 0
+    seen = set()
+
+    for obj in (read_rad, getattr(read_rad, 'rt_object', None)):
+        if obj is None:
+            continue
+
+        for value in vars(obj).values():
+            values = value.values() if isinstance(value, dict) else [value]
+
+            for item in values:
+                if isinstance(item, np.ndarray) and id(item) not in seen:
+                    seen.add(id(item))
+                    total += item.nbytes
+
+    return total
+
+
+class RadtransCache:
+    """
+    LRU cache of ``ReadRadtrans`` instances that is keyed on the opacity
+    configuration (species, wavelength range, pressure grid, etc.). The
+    least recently used instances are evicted when the summed size of
+    the cached instances exceeds ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes=8e9):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+
+    @staticmethod
+    def key(kwargs):
+        return tuple((item, tuple(value) if isinstance(value, list) else value)
+                     for item, value in sorted(kwargs.items()))
+
+    def get(self, **kwargs):
+        key = self.key(kwargs)
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        read_rad = read_radtrans.ReadRadtrans(**kwargs)
+
+        self.entries[key] = (read_rad, radtrans_nbytes(read_rad))
+        self.evict(keep=key)
+
+        return read_rad
+
+    def nbytes(self):
+        return sum(item[1] for item in self.entries.values())
+
+    def evict(self, keep=None):
+        while self.nbytes() > self.max_bytes and len(self.entries) > 1:
+            key = next(iter(self.entries))
+
+            if key == keep:
+                break
+
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+
+# Shared by all tags in one process
+RADTRANS_CACHE = RadtransCache()
+
+
+def data_window(objectbox, spec_res=None, margin=4., extra=None):
+    """
+    Wavelength range (um) that is covered by the spectra and filters
+    of an object (and the optional range ``extra``, e.g. the limits of a
+    plot), widened by ``margin`` standard deviations of the line spread
+    function at the lowest resolution of the spectra and ``spec_res``.
+    Within this window, the convolved model spectrum is identical to the
+    spectrum that is computed over a wider range, so the Radtrans
+    instances only need the opacities of this range.
+    """
+
+    limits = [] if extra is None else [extra[0], extra[1]]
+    resolution = [] if spec_res is None else [spec_res]
+
+    if objectbox.spectrum is not None:
+        for item in objectbox.spectrum.values():
+            limits.extend([np.amin(item[0][:, 0]), np.amax(item[0][:, 0])])
+
+            if len(item) > 3 and item[3] is not None:
+                resolution.append(item[3])
+
+    if objectbox.filters is not None:
+        for item in objectbox.filters:
+            limits.extend(read_filter.ReadFilter(item).wavelength_range())
+
+    low, high = float(np.amin(limits)), float(np.amax(limits))
+
+    if resolution:
+        # Standard deviation of the Gaussian line spread function at both edges
+        sigma = 1./np.amin(resolution)/(2.*np.sqrt(2.*np.log(2.)))
+        low, high = low*(1.-margin*sigma), high*(1.+margin*sigma)
+
+    return (float(round(low, 3)), float(round(high, 3)))
+
+
+def get_radtrans(database, tag, wavel_range=None, cache=RADTRANS_CACHE, setup=None):
+    """
+    Cached ``ReadRadtrans`` instance for the retrieval of ``tag``.
+    """
+
+    if setup is None:
+        setup = RetrievalSetup(database.database, tag)
+
+    read_rad = cache.get(**setup.radtrans_kwargs(wavel_range))
+
+    # The quenching is set per retrieval such that the parameter of get_model is not required
+    read_rad.quenching = setup.quenching
+
+    return read_rad
+
+
+# Parameters that only affect the clouds
+CLOUD_PARAMS = ('fsed', 'log_kzz', 'sigma_lnorm', 'log_tau_cloud', 'log_kappa_0', 'opa_index',
+                'log_p_base', 'albedo', 'log_kappa_abs', 'log_kappa_sca', 'opa_abs_index',
+                'opa_sca_index', 'lambda_ray')
+
+# Clouds with a smaller (log10) optical depth do not contribute to the spectrum
+CLOUD_FREE_LOG_TAU = -10.
+
+
+def is_cloud_free(model_param):
+    """
+    Check if the clouds of a parameter set are effectively absent.
+    """
+
+    return model_param.get('log_tau_cloud', 0.) <= CLOUD_FREE_LOG_TAU
+
+
+def clear_params(model_param, quenching=None):
+    """
+    Parameters without the cloud parameters. The eddy diffusion is
+    kept for the disequilibrium chemistry with diffusion quenching.
+    """
+
+    return {key: value for key, value in model_param.items()
+            if not (key in CLOUD_PARAMS and not (key == 'log_kzz' and quenching == 'diffusion'))
+            and not key.startswith('fsed_') and not key.endswith('_fraction')
+            and not (key.endswith('_ratio') and key != 'c_o_ratio')}
+
+
+@contextlib.contextmanager
+def clear_atmosphere(read_rad):
+    """
+    Use ``read_rad`` without cloud species and scattering inside the
+    ``with`` block, such that a spectrum costs as much as a clear
+    atmosphere while the opacities that are already loaded are reused.
+    The 'clouds' pressure grid (whose refinement is only required for
+    cloud decks) is replaced by the standard grid of 180 layers.
+    """
+
+    rt_object = read_rad.rt_object
+
+    saved = {'cloud_species': read_rad.cloud_species,
+             'scattering': read_rad.scattering,
+             'pressure_grid': read_rad.pressure_grid,
+             'pressure': read_rad.pressure}
+
+    saved_rt = {'cloud_species': rt_object.cloud_species,
+                'do_scat_emis': rt_object.do_scat_emis,
+                'test_ck_shuffle_comp': rt_object.test_ck_shuffle_comp}
+
+    read_rad.cloud_species = []
+    read_rad.scattering = False
+
+    # Scattering enforces test_ck_shuffle_comp, which a clear instance does not use
+    rt_object.cloud_species = []
+    rt_object.do_scat_emis = False
+    rt_object.test_ck_shuffle_comp = False
+
+    if read_rad.pressure_grid == 'clouds':
+        read_rad.pressure_grid = 'standard'
+        read_rad.pressure = np.logspace(-6., np.log10(read_rad.max_press), 180)
+        rt_object.setup_opa_structure(read_rad.pressure)
+
+    try:
+        yield read_rad
+
+    finally:
+        for key, value in saved.items():
+            setattr(read_rad, key, value)
+
+        for key, value in saved_rt.items():
+            setattr(rt_object, key, value)
+
+        if saved['pressure_grid'] == 'clouds':
+            # As set up by ReadRadtrans, the cloudy spectra set up their own grid
+            rt_object.setup_opa_structure(read_rad.pressure[::24])
+
+
+def read_samples(database, tag, random=None):
+    """
+    Posterior samples of ``tag``, optionally a random selection of
+    ``random`` samples. With the resampling index of a compacted
+    posterior, only the selected rows are read (see
+    :func:`HD72946B_storage.read_subset`).
+    """
+
+    samples = storage.read_subset(database.database, tag, random)
+
+    return samples
+
+
+def get_retrieval_spectra(database, tag, random, wavel_range=None, spec_res=None,
+                          cache=RADTRANS_CACHE):
+    """
+    Same as ``species.Database.get_retrieval_spectra`` but with the
+    ``ReadRadtrans`` instance taken from ``cache``, such that the
+    opacities are only loaded once for all tags.
+    """
+
+    setup = RetrievalSetup(database.database, tag)
+
+    samples = read_samples(database, tag, random)
+
+    read_rad = get_radtrans(database, tag, wavel_range=wavel_range, cache=cache, setup=setup)
+
+    boxes = []
+
+    for i, item in enumerate(samples):
+        print(f'\rGetting posterior spectra {i+1}/{samples.shape[0]}...', end='')
+
+        boxes.append(sample_spectrum(setup, read_rad, item, spec_res=spec_res))
+
+    print(' [DONE]')
+
+    return boxes, read_rad
+
+
+def sample_spectrum(setup, read_rad, sample, spec_res=None):
+    """
+    Model spectrum of one posterior sample (a row of the samples array).
+    """
+
+    # Radtrans shortens the names of the cloud species (e.g. 'MgSiO3(c)_cd'
+    # to 'MgSiO3(c)'), which is the format expected by retrieval_spectrum
+    return data_util.retrieval_spectrum(indices=setup.indices,
+                                        chemistry=setup.chemistry,
+                                        pt_profile=setup.pt_profile,
+                                        line_species=setup.line_species,
+                                        cloud_species=read_rad.cloud_species,
+                                        quenching=setup.quenching,
+                                        spec_res=spec_res,
+                                        distance=setup.distance,
+                                        pt_smooth=setup.pt_smooth(sample),
+                                        temp_nodes=setup.temp_nodes,
+                                        abund_nodes=setup.abund_nodes,
+                                        abund_smooth=setup.abund_smooth,
+                                        read_rad=read_rad,
+                                        sample=sample)
+
+
+class SpectraBatch:
+    """
+    Model spectra of a batch of posterior samples, stored as one stacked
+    ``flux`` array with shape (n_samples, n_wavelengths) on a common
+    ``wavelength`` grid instead of a list of ``ModelBox`` objects.
+    """
+
+    def __init__(self, tag, parameters, samples, wavelength, flux):
+        self.tag = tag
+        self.parameters = parameters
+        self.samples = samples
+        self.wavelength = wavelength
+        self.flux = flux
+
+    def boxes(self):
+        """
+        List of ``ModelBox`` objects, e.g. for ``species.plot_spectrum``.
+        """
+
+        boxes = []
+
+        for i in range(self.flux.shape[0]):
+            model_box = box.create_box(boxtype='model',
+                                       model='petitradtrans',
+                                       wavelength=self.wavelength,
+                                       flux=self.flux[i],
+                                       parameters=dict(zip(self.parameters, self.samples[i])),
+                                       quantity='flux',
+                                       contribution=None,
+                                       bol_flux=None)
+
+            # Same content type as the boxes of get_retrieval_spectra
+            model_box.type = 'mcmc'
+
+            boxes.append(model_box)
+
+        return boxes
+
+
+# State of a batch evaluation, inherited by the forked worker processes
+_BATCH = {}
+
+
+def _batch_spectrum(index):
+    model_box = sample_spectrum(_BATCH['setup'], _BATCH['read_rad'],
+                                _BATCH['samples'][index], spec_res=_BATCH['spec_res'])
+
+    return index, model_box.wavelength, model_box.flux
+
+
+def get_spectra_batch(database, tag, samples=None, random=None, wavel_range=None,
+                      spec_res=None, n_workers=None, cache=RADTRANS_CACHE):
+    """
+    Model spectra for a batch of posterior samples, provided as array
+    with shape (n_samples, n_param) or drawn with ``random``. The
+    radiative transfer is distributed over ``n_workers`` processes.
+    The workers are forked after the ``ReadRadtrans`` instance has been
+    created (or taken from ``cache``), so they share the opacities that
+    were loaded by the parent instead of loading them again. Returns a
+    :class:`SpectraBatch`.
+    """
+
+    setup = RetrievalSetup(database.database, tag)
+
+    if samples is None:
+        samples = read_samples(database, tag, random)
+
+    samples = np.atleast_2d(samples)
+
+    read_rad = get_radtrans(database, tag, wavel_range=wavel_range, cache=cache, setup=setup)
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    n_workers = max(1, min(n_workers, samples.shape[0]))
+
+    _BATCH.update({'setup': setup, 'read_rad': read_rad,
+                   'samples': samples, 'spec_res': spec_res})
+
+    flux = None
+
+    try:
+        if n_workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context('fork').Pool(n_workers) as pool:
+                results = pool.imap_unordered(_batch_spectrum, range(samples.shape[0]))
+                flux, wavelength = _stack(results, samples.shape[0])
+
+        else:
+            flux, wavelength = _stack(map(_batch_spectrum, range(samples.shape[0])), samples.shape[0])
+
+    finally:
+        _BATCH.clear()
+
+    print(' [DONE]')
+
+    return SpectraBatch(tag, list(setup.parameters), samples, wavelength, flux)
+
+
+def posterior_envelope(database, tag, random, wavel_range=None, spec_res=None, method='sketch',
+                       chunk_size=256, n_workers=None, cache=RADTRANS_CACHE):
+    """
+    Mean, median and 1 sigma / 2 sigma envelopes of the spectra of
+    ``random`` posterior samples. The spectra are computed in batches
+    of ``chunk_size`` samples and passed to an
+    :class:`~HD72946B_envelopes.EnvelopeEstimator` (``method``), so only
+    one batch of spectra is kept in memory. Returns an
+    :class:`~HD72946B_envelopes.Envelope`.
+    """
+
+    samples = read_samples(database, tag, random)
+
+    estimator = None
+
+    for start in range(0, samples.shape[0], chunk_size):
+        batch = get_spectra_batch(database, tag, samples=samples[start:start+chunk_size],
+                                  wavel_range=wavel_range, spec_res=spec_res,
+                                  n_workers=n_workers, cache=cache)
+
+        if estimator is None:
+            estimator = envelopes.EnvelopeEstimator(batch.wavelength, method=method)
+
+        estimator.update(batch.flux)
+
+    return estimator.result()
+
+
+def _stack(results, n_samples):
+    flux = None
+    wavelength = None
+
+    for count, (index, wavel_item, flux_item) in enumerate(results):
+        print(f'\rGetting posterior spectra {count+1}/{n_samples}...', end='')
+
+        if flux is None:
+            wavelength = wavel_item
+            flux = np.full((n_samples, flux_item.size), np.nan)
+
+        elif wavel_item.shape != wavelength.shape or not np.array_equal(wavel_item, wavelength):
+            raise ValueError('The model spectra of the batch do not have the same wavelengths, '
+                             'e.g. because of a fitted radial velocity.')
+
+        flux[index] = flux_item
+
+    return flux, wavelength
+
+
+# Wavelength range (um) over which database.get_retrieval_teff integrates the flux
+TEFF_WAVEL_RANGE = (0.5, 50.)
+
+
+class DerivedQuantities:
+    """
+    Quantities of posterior samples that are derived from one model
+    spectrum per sample: the effective temperature ``teff`` (K), the
+    bolometric luminosity ``log_l_bol`` (log10 L/Lsun) and the spectra
+    for the spectrum figure (``wavelength`` and ``flux``).
+    """
+
+    def __init__(self, tag, parameters, samples, teff, log_l_bol, wavelength, flux):
+        self.tag = tag
+        self.parameters = parameters
+        self.samples = samples
+        self.teff = teff
+        self.log_l_bol = log_l_bol
+        self.wavelength = wavelength
+        self.flux = flux
+
+    def spectra(self, n_samples=None):
+        """
+        :class:`SpectraBatch` with the spectra of the first
+        ``n_samples`` samples (all samples if ``None``).
+        """
+
+        return SpectraBatch(self.tag, self.parameters, self.samples[:n_samples],
+                            self.wavelength, self.flux[:n_samples])
+
+    def report(self):
+        for name, values, unit in (('Teff', self.teff, ' (K)'), ('log(L/Lsun)', self.log_l_bol, '')):
+            q_16, q_50, q_84 = np.percentile(values, [16., 50., 84.])
+            print(f'{name}{unit} = {q_50:.2f} (-{q_50-q_16:.2f} +{q_84-q_50:.2f})')
+
+
+def bolometric(setup, samples, wavelength, flux):
+    """
+    Teff (K) and log10(L/Lsun) of spectra with the flux (W m-2 um-1) at
+    the distance of the object. The flux is integrated at the resolution
+    of the model, since the convolution of get_retrieval_teff does not
+    change the integrated flux.
+    """
+
+    if 'parallax' in setup.indices:
+        distance = 1e3/samples[:, setup.indices['parallax']]
+    else:
+        distance = np.full(samples.shape[0], setup.distance)
+
+    radius = samples[:, setup.indices['radius']]*constants.R_JUP
+
+    # Flux at the surface of the object
+    flux_int = trapezoid(flux, wavelength, axis=1)*(distance*constants.PARSEC/radius)**2
+
+    teff = (flux_int/constants.SIGMA_SB)**0.25
+    log_l_bol = np.log10(4.*np.pi*radius**2*flux_int/constants.L_SUN)
+
+    return teff, log_l_bol
+
+
+def _derived_key(database, tag, random, spec_res, wavel_range, teff_range, setup):
+    content = {'samples': storage.content_id(database.database, tag),
+               'random': random,
+               'spec_res': None if spec_res is None else float(spec_res),
+               'wavel_range': None if wavel_range is None else [float(item) for item in wavel_range],
+               'teff_range': [float(item) for item in teff_range],
+               'radtrans': {key: value if not isinstance(value, tuple) else list(value)
+                            for key, value in setup.radtrans_kwargs(teff_range).items()}}
+
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def derived_quantities(database, tag, random, wavel_range=None, spec_res=None,
+                       teff_range=TEFF_WAVEL_RANGE, n_workers=None, cache=None,
+                       before_write=None):
+    """
+    Teff, L_bol and posterior spectra of ``random`` samples of ``tag``,
+    derived from one model spectrum per sample over ``teff_range``
+    instead of separate passes for ``get_retrieval_teff`` and
+    ``get_retrieval_spectra``. The spectra for the figure are convolved
+    to ``spec_res`` and limited to ``wavel_range``. The results are
+    stored in ``results/derived/<tag>`` of the database, and later calls
+    with the same arguments and posterior samples are read from there.
+    ``before_write`` is called before the database is opened for
+    writing. The Radtrans instance over ``teff_range`` has all opacities
+    of 0.5-50 um, so by default it is not kept in the shared
+    :data:`RADTRANS_CACHE` (which holds the windowed instances of the
+    figures) but created in a cache of this call, and released once
+    Teff has been computed. Returns a :class:`DerivedQuantities`.
+    """
+
+    setup = RetrievalSetup(database.database, tag)
+
+    key = _derived_key(database, tag, random, spec_res, wavel_range, teff_range, setup)
+
+    with h5py.File(database.database, 'r') as h5_file:
+        group = h5_file.get(f'results/derived/{tag}')
+
+        if group is not None and group.attrs.get('key', '') == key:
+            print(f'Reading Teff and posterior spectra of {tag} from the database')
+
+            derived = DerivedQuantities(tag, list(setup.parameters),
+                                        *[np.asarray(group[item]) for item in
+                                          ('samples', 'teff', 'log_l_bol', 'wavelength', 'flux')])
+            derived.report()
+
+            return derived
+
+    if cache is None:
+        cache = RadtransCache()
+
+    batch = get_spectra_batch(database, tag, random=random, wavel_range=teff_range,
+                              n_workers=n_workers, cache=cache)
+
+    # Release the full-range opacities, unless the caller keeps them
+    del cache
+
+    teff, log_l_bol = bolometric(setup, batch.samples, batch.wavelength, batch.flux)
+
+    flux = batch.flux
+
+    if spec_res is not None:
+        flux = np.array([retrieval_util.convolve(batch.wavelength, item, spec_res) for item in flux])
+
+    # The convolution is applied before the cut, so there are no edge effects within wavel_range
+    if wavel_range is not None:
+        indices = (batch.wavelength >= wavel_range[0]) & (batch.wavelength <= wavel_range[1])
+    else:
+        indices = np.ones(batch.wavelength.size, dtype=bool)
+
+    derived = DerivedQuantities(tag, batch.parameters, batch.samples, teff, log_l_bol,
+                                batch.wavelength[indices], flux[:, indices])
+    derived.report()
+
+    if before_write is not None:
+        before_write()
+
+    with h5py.File(database.database, 'a') as h5_file:
+        if f'results/derived/{tag}' in h5_file:
+            del h5_file[f'results/derived/{tag}']
+
+        group = h5_file.create_group(f'results/derived/{tag}')
+
+        for item in ('samples', 'teff', 'log_l_bol', 'wavelength', 'flux'):
+            group.create_dataset(item, data=getattr(derived, item))
+
+        group.attrs['key'] = key
+
+    return derived
+
+
+class Contribution:
+    """
+    Emission contribution function of a model, normalized at each
+    wavelength, with shape (n_pressures, n_wavelengths). ``profile`` is
+    the mean of the contribution function over wavelength before the
+    normalization, as drawn on the P-T figure by ``plot_pt_profile``.
+    ``photo_press`` is the pressure (bar) at optical depth 2/3 at each
+    wavelength.
+    """
+
+    def __init__(self, wavelength, pressure, contribution, profile, photo_press):
+        self.wavelength = wavelength
+        self.pressure = pressure
+        self.contribution = contribution
+        self.profile = profile
+        self.photo_press = photo_press
+
+    def photosphere(self):
+        """
+        Pressure (bar) of the photosphere at each wavelength, at optical
+        depth 2/3 as in the 'photosphere' axis of ``plot_pt_profile``.
+        """
+
+        return self.photo_press
+
+
+def _photosphere(read_rad):
+    # Optical depth of the last radiative transfer, averaged over the
+    # cumulative opacity distribution as in plot_pt_profile
+    rt_object = read_rad.rt_object
+    total_tau = getattr(rt_object, 'total_tau', None)
+
+    if total_tau is None:
+        raise ValueError('The model does not provide the optical depth.')
+
+    if read_rad.scattering:
+        optical_depth = np.sum(rt_object.w_gauss[..., np.newaxis, np.newaxis]*total_tau[:, :, 0, :], axis=0)
+    else:
+        optical_depth = np.sum(rt_object.w_gauss[..., np.newaxis, np.newaxis, np.newaxis]*total_tau, axis=0)
+        optical_depth = np.sum(optical_depth, axis=1)
+
+    # The pressures of Radtrans are in cgs units
+    pressure = np.asarray(rt_object.press)*1e-6
+
+    return np.array([np.interp(2./3., item, pressure) for item in optical_depth])
+
+
+def _contribution(read_rad, model_box):
+    # Contribution function of the last radiative transfer with contribution=True
+    contribution = getattr(model_box, 'contribution', None)
+
+    if contribution is None or np.ndim(contribution) != 2:
+        contribution = getattr(read_rad.rt_object, 'contr_em', None)
+
+    if contribution is None:
+        raise ValueError('The model does not provide the emission contribution function.')
+
+    contribution = np.asarray(contribution, dtype=float)
+
+    pressure = getattr(read_rad.rt_object, 'press', None)
+
+    if pressure is not None and np.size(pressure) == contribution.shape[0]:
+        # The pressures of Radtrans are in cgs units
+        pressure = np.asarray(pressure)*1e-6
+    else:
+        pressure = np.asarray(read_rad.pressure)
+
+    wavelength = 1e6*constants.LIGHT/np.asarray(read_rad.rt_object.freq)
+
+    profile = np.mean(contribution, axis=1)
+    photo_press = _photosphere(read_rad)
+
+    norm = np.sum(contribution, axis=0)
+    contribution = contribution/np.where(norm > 0., norm, 1.)
+
+    order = np.argsort(wavelength)
+
+    return Contribution(wavelength[order], pressure, contribution[:, order], profile, photo_press[order])
+
+
+def get_contribution(database, tag, read_rad, model_param, plot_contribution=None,
+                     model_cache=None, before_write=None):
+    """
+    Emission contribution function of the model of ``tag`` with
+    ``model_param`` (e.g. the best-fit parameters). It is only computed
+    when requested and stored as compressed float32 array in
+    ``results/contribution/<tag>`` of the database, such that later
+    requests do not run the radiative transfer. Since ``get_model``
+    always computes the contribution, it is read from an ordinary call
+    through ``model_cache`` (which stores the spectrum) together with the
+    optical depths of ``read_rad.rt_object``. With ``plot_contribution``,
+    the figure of ``get_model`` is also created. ``before_write`` is called before the database is
+    opened for writing. Returns a :class:`Contribution`.
+    """
+
+    key = model_hash(read_rad, model_param)
+
+    if plot_contribution is None:
+        with h5py.File(database.database, 'r') as h5_file:
+            group = h5_file.get(f'results/contribution/{tag}')
+
+            if group is not None and group.attrs.get('key', '') == key and 'photo_press' in group:
+                return Contribution(*[np.asarray(group[item], dtype=float)
+                                      for item in ('wavelength', 'pressure', 'contribution',
+                                                   'profile', 'photo_press')])
+
+    if model_cache is None:
+        model_cache = ModelCache()
+
+    # The optical depths are read from rt_object, so the radiative transfer has to run
+    model_box = model_cache.get_model(read_rad, model_param, refresh=True,
+                                      plot_contribution=plot_contribution if plot_contribution else False)
+
+    contribution = _contribution(read_rad, model_box)
+
+    if before_write is not None:
+        before_write()
+
+    with h5py.File(database.database, 'a') as h5_file:
+        if f'results/contribution/{tag}' in h5_file:
+            del h5_file[f'results/contribution/{tag}']
+
+        group = h5_file.create_group(f'results/contribution/{tag}')
+
+        group.create_dataset('wavelength', data=contribution.wavelength)
+        group.create_dataset('pressure', data=contribution.pressure)
+        group.create_dataset('contribution', data=contribution.contribution.astype(np.float32),
+                             compression='gzip', shuffle=True)
+        group.create_dataset('profile', data=contribution.profile)
+        group.create_dataset('photo_press', data=contribution.photo_press)
+
+        group.attrs['key'] = key
+
+    return contribution
+
+
+def radtrans_config(read_rad):
+    """
+    Configuration of a ``ReadRadtrans`` instance that determines the
+    model spectrum for a given set of parameters.
+    """
+
+    return {'line_species': list(read_rad.line_species),
+            'cloud_species': list(read_rad.cloud_species),
+            'scattering': bool(read_rad.scattering),
+            'wavel_range': [float(item) for item in read_rad.wavel_range],
+            'pressure_grid': read_rad.pressure_grid,
+            'cloud_wavel': None if read_rad.cloud_wavel is None else [float(item) for item in read_rad.cloud_wavel],
+            'max_press': float(read_rad.max_press),
+            'res_mode': getattr(read_rad.rt_object, 'mode', None),
+            'lbl_opacity_sampling': None if read_rad.lbl_opacity_sampling is None else int(read_rad.lbl_opacity_sampling),
+            'quenching': getattr(read_rad, 'quenching', None)}
+
+
+def model_hash(read_rad, model_param, **kwargs):
+    """
+    Canonical hash of a model evaluation: the parameters, the
+    ``ReadRadtrans`` configuration and the arguments of ``get_model``
+    (e.g. ``spec_res``). Arrays, such as ``wavel_resample``, are hashed
+    by their content.
+    """
+
+    content = {'param': {key: float(value) for key, value in model_param.items()},
+               'radtrans': radtrans_config(read_rad)}
+
+    for key, value in sorted(kwargs.items()):
+        if isinstance(value, np.ndarray):
+            value = hashlib.sha256(np.ascontiguousarray(value, dtype=float).tobytes()).hexdigest()
+        elif isinstance(value, (np.floating, np.integer)):
+            value = value.item()
+        content[key] = value
+
+    canonical = json.dumps(content, sort_keys=True, separators=(',', ':'))
+
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ModelCache:
+    """
+    Content-addressed cache in front of ``ReadRadtrans.get_model``. The
+    spectrum without smoothing is stored per parameter set, and smoothed
+    spectra (``spec_res``) are derived from it with the same Gaussian
+    convolution as in ``get_model``, so the radiative transfer only runs
+    once for identical parameters. With ``cache_folder``, the spectra
+    are also written to disk such that a rerun of the figures script
+    (e.g. after a crash) reuses the finished models.
+    """
+
+    def __init__(self, cache_folder=None):
+        self.cache_folder = cache_folder
+        self.boxes = {}
+
+        # Unpatched get_model of the instances within memoize
+        self.originals = {}
+
+        if cache_folder is not None and not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder)
+
+    def _filename(self, key):
+        return os.path.join(self.cache_folder, key+'.npz')
+
+    def _load(self, key):
+        if key in self.boxes:
+            return self.boxes[key]
+
+        if self.cache_folder is not None and os.path.exists(self._filename(key)):
+            with np.load(self._filename(key)) as npz_file:
+                data = dict(npz_file)
+
+            model_box = box.create_box(boxtype='model',
+                                       model='petitradtrans',
+                                       wavelength=data['wavelength'],
+                                       flux=data['flux'],
+                                       parameters=json.loads(str(data['parameters'])),
+                                       quantity='flux',
+                                       contribution=data.get('contribution', None),
+                                       bol_flux=data.get('bol_flux', None))
+
+            self.boxes[key] = model_box
+
+            return model_box
+
+        return None
+
+    def _store(self, key, model_box):
+        self.boxes[key] = model_box
+
+        if self.cache_folder is not None:
+            data = {'wavelength': model_box.wavelength,
+                    'flux': model_box.flux,
+                    'parameters': json.dumps({item: float(value) for item, value in model_box.parameters.items()})}
+
+            for item in ('contribution', 'bol_flux'):
+                if getattr(model_box, item, None) is not None:
+                    data[item] = getattr(model_box, item)
+
+            # Write to a temporary file first such that an interrupted run leaves no partial file
+            tmp_file = self._filename(key)+'.tmp.npz'
+            np.savez(tmp_file, **data)
+            os.replace(tmp_file, self._filename(key))
+
+    def _run(self, read_rad, model_param, **kwargs):
+        get_model = self.originals.get(id(read_rad), read_rad.get_model)
+
+        return get_model(dict(model_param), **kwargs)
+
+    def get_model(self, read_rad, model_param, spec_res=None, wavel_resample=None,
+                  plot_contribution=False, cloud_free=None, refresh=False, **kwargs):
+        """
+        Memoized version of ``read_rad.get_model``. A call with
+        ``plot_contribution`` always runs the radiative transfer since
+        the figure is created by ``get_model``. With ``refresh``, the
+        radiative transfer also runs (and the cache is updated), such
+        that ``read_rad.rt_object`` holds the state of the model after
+        the call. With ``cloud_free``
+        (by default if ``log_tau_cloud`` is below ``CLOUD_FREE_LOG_TAU``),
+        the spectrum is computed without clouds and scattering by the
+        same instance (see :func:`clear_atmosphere`).
+        """
+
+        if cloud_free is None:
+            cloud_free = len(read_rad.cloud_species) > 0 and is_cloud_free(model_param)
+
+        if cloud_free and len(read_rad.cloud_species) > 0:
+            with clear_atmosphere(read_rad):
+                return self.get_model(read_rad,
+                                      clear_params(model_param, quenching=getattr(read_rad, 'quenching', None)),
+                                      spec_res=spec_res,
+                                      wavel_resample=wavel_resample,
+                                      plot_contribution=plot_contribution,
+                                      cloud_free=False,
+                                      refresh=refresh,
+                                      **kwargs)
+
+        # The radial velocity shift and resampling are applied after the
+        # smoothing in get_model, so then the smoothed spectrum is not
+        # derived from the cached spectrum but computed directly
+        derive = wavel_resample is None and 'rad_vel' not in model_param and not kwargs
+
+        raw_key = model_hash(read_rad, model_param)
+
+        if derive:
+            key = raw_key if spec_res is None else model_hash(read_rad, model_param, spec_res=spec_res)
+        else:
+            key = model_hash(read_rad, model_param, spec_res=spec_res,
+                             wavel_resample=wavel_resample, **kwargs)
+
+        refresh = refresh or bool(plot_contribution)
+
+        model_box = None if refresh else self._load(key)
+
+        if model_box is None and derive:
+            raw_box = None if refresh else self._load(raw_key)
+
+            if raw_box is None:
+                raw_box = self._run(read_rad, model_param, plot_contribution=plot_contribution)
+                self._store(raw_key, raw_box)
+
+            if spec_res is None:
+                model_box = raw_box
+
+            else:
+                model_box = copy.deepcopy(raw_box)
+                model_box.flux = retrieval_util.convolve(raw_box.wavelength, raw_box.flux, spec_res)
+                self._store(key, model_box)
+
+        elif model_box is None:
+            model_box = self._run(read_rad, model_param,
+                                  spec_res=spec_res,
+                                  wavel_resample=wavel_resample,
+                                  plot_contribution=plot_contribution,
+                                  **kwargs)
+            self._store(key, model_box)
+
+        # Return a copy such that the caller can not modify the cached spectrum
+        return copy.deepcopy(model_box)
+
+    @contextlib.contextmanager
+    def memoize(self, read_rad):
+        """
+        Context manager that routes ``read_rad.get_model`` through the
+        cache, e.g. for ``species.get_residuals`` which computes the same
+        model for the spectra and for the photometry. It should only be
+        used around functions that use the returned ``ModelBox`` and not
+        the state of ``read_rad.rt_object`` after the call.
+        """
+
+        # A cache miss runs the original method, not the patched one
+        self.originals[id(read_rad)] = read_rad.get_model
+
+        def get_model(model_param, **kwargs):
+            return self.get_model(read_rad, model_param, **kwargs)
+
+        read_rad.get_model = get_model
+
+        try:
+            yield read_rad
+
+        finally:
+            del read_rad.get_model
+            del self.originals[id(read_rad)]
@@ -0,0 +1,250 @@
+################################################################################
+# Node-level shared opacity store for retrievals with MPI. Every rank of       #
+# run_multinest creates its own Radtrans instance with the same line and       #
+# cloud opacity tables. Here only the first rank of a node reads the tables    #
+# (read_line_opacities and read_cloud_opas of petitRADTRANS). It writes the    #
+# large arrays to memory-mapped files in a node-local folder (/dev/shm by      #
+# default) and broadcasts the other attributes that the readers set. The       #
+# other ranks skip the readers and attach copy-on-write maps of the files, so  #
+# the tables are read from disk once per node and all ranks of a node share    #
+# the same physical pages.                                                     #
+################################################################################
+import contextlib
+import copy
+import hashlib
+import os
+
+import numpy as np
+
+# Methods of Radtrans (inherited from ReadOpacities) that read the line and
+# cloud opacity tables. The attributes that they set are only read after the
+# initialization, in contrast to the opacity structures of the atmosphere that
+# are rewritten every call
+READERS = ('read_line_opacities', 'read_cloud_opas')
+
+# Arrays smaller than this are broadcast instead of shared (bytes)
+MIN_BYTES = 1e6
+
+
+def node_comm():
+    """
+    Communicator of the MPI ranks on this node, or ``None`` without
+    MPI or with a single rank on the node.
+    """
+
+    try:
+        from mpi4py import MPI
+
+    except ModuleNotFoundError:
+        return None
+
+    comm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+
+    if comm.Get_size() == 1:
+        return None
+
+    return comm
+
+
+def _snapshot(rt_object):
+    # Shallow copies of the lists and dicts, to detect changes in place
+    return {key: (value, copy.copy(value) if isinstance(value, (list, dict)) else None)
+            for key, value in vars(rt_object).items()}
+
+
+def _changed(snapshot, key, value):
+    if key not in snapshot:
+        return True
+
+    original, content = snapshot[key]
+
+    if value is not original:
+        return True
+
+    if content is None:
+        return False
+
+    try:
+        return bool(content != value)
+
+    except ValueError:
+        # Containers with arrays can not be compared, so they are sent again
+        return True
+
+
+class SharedOpacityStore:
+    """
+    Shares the opacity tables of the Radtrans instances that are
+    created while the store is installed. The ranks of a node have to
+    create their Radtrans instances together, as in ``run_multinest``.
+    """
+
+    def __init__(self, folder='/dev/shm', comm=None):
+        self.comm = node_comm() if comm is None else comm
+
+        # Unique folder of this run, named by rank 0 of the node
+        name = f'hd72946b_opacities_{os.getpid()}'
+
+        if self.comm is not None:
+            name = self.comm.bcast(name, root=0)
+
+        self.folder = os.path.join(folder, name)
+        self.patched = []
+        self.n_read = 0
+
+    def _filename(self, attribute, key):
+        name = hashlib.sha1(f'{self.n_read}/{attribute}/{key}'.encode()).hexdigest()
+        return os.path.join(self.folder, f'{name}.npy')
+
+    def _write(self, array, attribute, key=None):
+        filename = self._filename(attribute, key)
+
+        # np.save keeps the memory order that the Fortran routines expect
+        np.save(filename+'.tmp.npy', array)
+        os.replace(filename+'.tmp.npy', filename)
+
+        return ('shared', filename, array.shape, array.dtype.str)
+
+    @staticmethod
+    def _attach(item):
+        _, filename, shape, dtype = item
+
+        shared = np.load(filename, mmap_mode='c')
+
+        if shared.shape != tuple(shape) or shared.dtype.str != dtype:
+            raise ValueError(f'The shared opacities in {filename} do not match: '
+                             f'{shared.shape} vs. {tuple(shape)}')
+
+        return shared
+
+    def describe(self, rt_object, snapshot):
+        """
+        Attributes of ``rt_object`` that were set by a reader. Large
+        arrays (also in dicts) are written to files and described by
+        their file, the other values are sent as they are.
+        """
+
+        attributes = {}
+
+        for attribute, value in vars(rt_object).items():
+            if not _changed(snapshot, attribute, value):
+                continue
+
+            if isinstance(value, np.ndarray) and value.nbytes >= MIN_BYTES:
+                attributes[attribute] = self._write(value, attribute)
+
+            elif isinstance(value, dict) and any(isinstance(item, np.ndarray) and item.nbytes >= MIN_BYTES
+                                                 for item in value.values()):
+                attributes[attribute] = ('dict', {key: self._write(item, attribute, key)
+                                                  if isinstance(item, np.ndarray) and item.nbytes >= MIN_BYTES
+                                                  else ('value', item) for key, item in value.items()})
+
+            else:
+                attributes[attribute] = ('value', value)
+
+        return attributes
+
+    def restore(self, rt_object, attributes):
+        for attribute, item in attributes.items():
+            if item[0] == 'shared':
+                value = self._attach(item)
+
+            elif item[0] == 'dict':
+                value = {key: self._attach(entry) if entry[0] == 'shared' else entry[1]
+                         for key, entry in item[1].items()}
+
+            else:
+                value = item[1]
+
+            setattr(rt_object, attribute, value)
+
+    def reader(self, func):
+        store = self
+
+        def read(self, *args, **kwargs):
+            comm = store.comm
+            rank = comm.Get_rank()
+
+            attributes = None
+
+            if rank == 0:
+                try:
+                    if not os.path.isdir(store.folder):
+                        os.makedirs(store.folder)
+
+                    snapshot = _snapshot(self)
+                    func(self, *args, **kwargs)
+                    attributes = store.describe(self, snapshot)
+
+                finally:
+                    # None tells the other ranks that reading failed
+                    attributes = comm.bcast(attributes, root=0)
+
+            else:
+                attributes = comm.bcast(None, root=0)
+
+                if attributes is None:
+                    raise RuntimeError(f'Rank 0 of the node failed to read the opacities ({func.__name__}).')
+
+            # Rank 0 also replaces its private tables by the maps
+            store.restore(self, attributes)
+
+            store.n_read += 1
+
+            # The mappings stay valid after the files are removed
+            comm.Barrier()
+
+            if rank == 0:
+                for item in attributes.values():
+                    entries = item[1].values() if item[0] == 'dict' else [item]
+
+                    for entry in entries:
+                        if entry[0] == 'shared':
+                            os.remove(entry[1])
+
+        return read
+
+    def install(self):
+        if self.comm is None:
+            return
+
+        from petitRADTRANS import radtrans
+
+        for name in READERS:
+            owner = next((item for item in radtrans.Radtrans.__mro__ if name in vars(item)), None)
+
+            if owner is None:
+                continue
+
+            original = vars(owner)[name]
+            self.patched.append((owner, name, original))
+            setattr(owner, name, self.reader(original))
+
+    def uninstall(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+
+        self.patched = []
+
+        if self.comm is not None:
+            self.comm.Barrier()
+
+            if self.comm.Get_rank() == 0 and os.path.isdir(self.folder):
+                os.rmdir(self.folder)
+
+
+@contextlib.contextmanager
+def shared_opacities(folder='/dev/shm'):
+    """
+    Share the opacity tables of the MPI ranks on each node for the
+    retrievals that run inside the ``with`` block.
+    """
+
+    store = SharedOpacityStore(folder=folder)
+    store.install()
+
+    try:
+        yield store
+
+    finally:
+        store.uninstall()
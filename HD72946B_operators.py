@@ -0,0 +1,270 @@
+################################################################################
+# Precomputed instrument operators for the retrieval likelihood. For a fixed   #
+# model wavelength grid, the convolution to the resolution of a spectrum       #
+# (SPHERE R=50, GRAVITY R=500), the rebinning to its wavelengths and the       #
+# synthetic photometry of a filter (IRDIS H23) are linear in the flux. Each    #
+# operator is therefore built once as a sparse matrix, by applying the         #
+# original species/petitRADTRANS function to the unit vectors, checked         #
+# against the original function and cached in memory and on disk. During the  #
+# retrieval, the functions are replaced by a sparse matrix-vector product.     #
+################################################################################
+import contextlib
+import hashlib
+import importlib
+import os
+import warnings
+
+import numpy as np
+
+from scipy import sparse
+
+# (module, attribute) of the convolution and rebinning functions. Functions
+# that are imported inside run_multinest are looked up at call time
+CONVOLVE = (('species.util.retrieval_util', 'convolve'),)
+REBIN = (('petitRADTRANS.retrieval.rebin_give_width', 'rebin_give_width'),)
+
+# (module, class) of the synthetic photometry
+PHOTOMETRY = (('species.analysis.photometry', 'SyntheticPhotometry'),
+              ('species', 'SyntheticPhotometry'))
+
+
+def _import(module_name):
+    try:
+        return importlib.import_module(module_name)
+
+    except ImportError:
+        return None
+
+
+def digest(*arrays):
+    """
+    Hash of one or more arrays (the model or data wavelength grids).
+    """
+
+    sha = hashlib.sha1()
+
+    for item in arrays:
+        item = np.ascontiguousarray(item, dtype=float)
+        sha.update(str(item.shape).encode())
+        sha.update(item.tobytes())
+
+    return sha.hexdigest()
+
+
+def probe(func, n_in):
+    """
+    Matrix of a linear function of a flux array with ``n_in`` points,
+    from its response to each unit vector.
+    """
+
+    rows, cols, data = [], [], []
+    n_out = None
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+
+        for j in range(n_in):
+            unit = np.zeros(n_in)
+            unit[j] = 1.
+
+            column = np.atleast_1d(np.asarray(func(unit), dtype=float))
+            n_out = column.size
+
+            indices = np.flatnonzero(column)
+            rows.append(indices)
+            cols.append(np.full(indices.size, j))
+            data.append(column[indices])
+
+    return sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(n_out, n_in))
+
+
+class InstrumentOperators:
+    """
+    Sparse operators for the convolution, rebinning and synthetic
+    photometry of the likelihood, keyed on the wavelength grids and
+    resolution or filter. Operators are stored in ``cache_folder``
+    (if set) and only used if they reproduce the original function
+    for the first flux with which they are applied. Model grids
+    larger than ``max_size`` (e.g. line-by-line) use the original
+    functions.
+    """
+
+    def __init__(self, cache_folder=None, max_size=20000, rtol=1e-8):
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+        self.rtol = rtol
+
+        self.operators = {}
+        self.patched = []
+
+        if cache_folder is not None and not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.cache_folder, key+'.npz')
+
+    def get(self, key, build, original, flux):
+        """
+        Operator for ``key``, which is loaded from the cache or built
+        with ``build``. A new operator is checked by comparing with
+        ``original`` (the result of the original function for
+        ``flux``). Returns ``None`` if the operator can not be used.
+        """
+
+        if key in self.operators:
+            return self.operators[key]
+
+        operator = None
+
+        if self.cache_folder is not None and os.path.exists(self._filename(key)):
+            operator = sparse.load_npz(self._filename(key))
+
+        if operator is None:
+            operator = build()
+
+            if self.cache_folder is not None:
+                # Unique temporary file, since MPI ranks can build the same operator
+                tmp_file = self._filename(key)+f'.{os.getpid()}.npz'
+                sparse.save_npz(tmp_file, operator)
+                os.replace(tmp_file, self._filename(key))
+
+        original = np.atleast_1d(np.asarray(original(), dtype=float))
+        result = operator @ flux
+
+        if original.shape != result.shape or \
+                not np.allclose(result, original, rtol=self.rtol, atol=self.rtol*np.amax(np.abs(original))):
+            warnings.warn(f'The sparse operator {key} does not reproduce the original '
+                          f'function, so the original function is used.')
+            operator = None
+
+        self.operators[key] = operator
+
+        return operator
+
+    def _patch(self, owner, name, wrapper):
+        if owner is None or not callable(getattr(owner, name, None)):
+            return
+
+        if any(item[0] is owner and item[1] == name for item in self.patched):
+            return
+
+        original = getattr(owner, name)
+        self.patched.append((owner, name, original))
+        setattr(owner, name, wrapper(original))
+
+    def convolve(self, func):
+        def convolve(input_wavel, input_flux, spec_res):
+            input_flux = np.asarray(input_flux)
+
+            if input_flux.ndim != 1 or input_flux.size > self.max_size or not np.all(np.isfinite(input_flux)):
+                return func(input_wavel, input_flux, spec_res)
+
+            key = 'convolve_'+digest(input_wavel, [spec_res])
+
+            operator = self.get(key,
+                                lambda: probe(lambda unit: func(input_wavel, unit, spec_res), input_flux.size),
+                                lambda: func(input_wavel, input_flux, spec_res),
+                                input_flux)
+
+            if operator is None:
+                return func(input_wavel, input_flux, spec_res)
+
+            return operator @ input_flux
+
+        return convolve
+
+    def rebin(self, func):
+        def rebin_give_width(input_wavel, input_flux, rebin_wavel, rebin_width):
+            input_flux = np.asarray(input_flux)
+
+            if input_flux.ndim != 1 or input_flux.size > self.max_size or not np.all(np.isfinite(input_flux)):
+                return func(input_wavel, input_flux, rebin_wavel, rebin_width)
+
+            key = 'rebin_'+digest(input_wavel, rebin_wavel, rebin_width)
+
+            operator = self.get(key,
+                                lambda: probe(lambda unit: func(input_wavel, unit, rebin_wavel, rebin_width),
+                                              input_flux.size),
+                                lambda: func(input_wavel, input_flux, rebin_wavel, rebin_width),
+                                input_flux)
+
+            if operator is None:
+                return func(input_wavel, input_flux, rebin_wavel, rebin_width)
+
+            return operator @ input_flux
+
+        return rebin_give_width
+
+    def photometry(self, func):
+        def spectrum_to_flux(synphot, wavelength, flux, *args, **kwargs):
+            flux = np.asarray(flux)
+
+            # Only the synthetic flux without uncertainties is linear
+            if args or kwargs or flux.ndim != 1 or flux.size > self.max_size or not np.all(np.isfinite(flux)):
+                return func(synphot, wavelength, flux, *args, **kwargs)
+
+            key = 'photometry_'+digest(wavelength)+'_'+hashlib.sha1(synphot.filter_name.encode()).hexdigest()[:16]
+
+            if key not in self.operators:
+                # The uncertainty has to be None such that the result is linear
+                if func(synphot, wavelength, flux)[1] is not None:
+                    self.operators[key] = None
+
+            operator = self.get(key,
+                                lambda: probe(lambda unit: func(synphot, wavelength, unit)[0], flux.size),
+                                lambda: func(synphot, wavelength, flux)[0],
+                                flux)
+
+            if operator is None:
+                return func(synphot, wavelength, flux)
+
+            return (operator @ flux)[0], None
+
+        return spectrum_to_flux
+
+    def install(self):
+        """
+        Replace the convolution, rebinning and synthetic photometry
+        functions that the likelihood of ``run_multinest`` calls.
+        """
+
+        retrieval = _import('species')
+
+        if retrieval is not None and hasattr(retrieval, 'AtmosphericRetrieval'):
+            retrieval = _import(retrieval.AtmosphericRetrieval.__module__)
+        else:
+            retrieval = None
+
+        for functions, wrapper in ((CONVOLVE, self.convolve), (REBIN, self.rebin)):
+            for module_name, name in functions:
+                self._patch(_import(module_name), name, wrapper)
+
+                # Functions that the retrieval module imported by name
+                self._patch(retrieval, name, wrapper)
+
+        for module_name, class_name in PHOTOMETRY:
+            self._patch(getattr(_import(module_name), class_name, None), 'spectrum_to_flux', self.photometry)
+
+    def uninstall(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+
+        self.patched = []
+
+
+@contextlib.contextmanager
+def instrument_operators(cache_folder=None):
+    """
+    Use the sparse instrument operators for the retrievals that run
+    inside the ``with`` block.
+    """
+
+    operators = InstrumentOperators(cache_folder)
+    operators.install()
+
+    try:
+        yield operators
+
+    finally:
+        operators.uninstall()
@@ -0,0 +1,676 @@
+################################################################################
+# Helpers shared by HD72946B_final_retrieval_comparison.py and                 #
+# HD72946B_final_retrieval_figures.py. The retrieval variants are read from    #
+# the experiment manifest (HD72946B_retrievals.toml) and resolved into a       #
+# configuration with a content hash, so that the same retrieval, ingestion     #
+# or figure job is never executed twice in one invocation.                     #
+################################################################################
+import contextlib
+import copy
+import functools
+import hashlib
+import json
+import os
+
+try:
+    import tomllib
+except ModuleNotFoundError:
+    import tomli as tomllib
+
+import h5py
+import species
+
+import HD72946B_build as build
+import HD72946B_chemistry as chemistry
+import HD72946B_covariance as covariance
+import HD72946B_envelopes as envelopes
+import HD72946B_models as models
+import HD72946B_opacities as opacities
+import HD72946B_operators as operators
+import HD72946B_posteriors as posteriors
+import HD72946B_pressure as pressure
+import HD72946B_profile as profile
+import HD72946B_render as render
+import HD72946B_storage as storage
+import HD72946B_stream as stream
+
+MANIFEST = 'HD72946B_retrievals.toml'
+
+# Keys of [retrieval] that are arguments of species.AtmosphericRetrieval
+RETRIEVAL_KEYS = ('line_species', 'cloud_species', 'scattering', 'wavel_range',
+                  'inc_spec', 'inc_phot', 'pressure_grid', 'weights')
+
+# Keys of [retrieval] that are arguments of AtmosphericRetrieval.run_multinest
+MULTINEST_KEYS = ('chemistry', 'quenching', 'pt_profile', 'fit_corr',
+                  'n_live_points', 'resume', 'plotting', 'pt_smooth')
+
+# Keys of [retrieval] that control the stages instead of the retrieval itself
+STAGE_KEYS = ('run', 'inc_teff', 'min_ess', 'profile', 'operators', 'operator_cache_folder',
+              'shared_opacities', 'opacity_store_folder',
+              'chemistry_grid', 'chemistry_interp', 'chemistry_cache_file', 'chemistry_tolerance',
+              'pressure_cache', 'pressure_tolerance', 'pressure_cache_size',
+              'correlated_noise', 'correlated_noise_min_size',
+              'compact_posterior', 'posterior_chunk_rows', 'posterior_float32')
+
+# Plot settings of the observations in the spectrum figure
+DATA_KWARGS = {
+    'GRAVITY': {'zorder':1,'marker': '', 'ms': 5., 'mew': 0., 'color': 'xkcd:brick', 'ls': 'none', 'alpha': 1, 'label': 'VLTI/GRAVITY'},
+    'SPHERE': {'zorder':1,'marker': '', 'ms': 5., 'mew': 0., 'color': '#5f61b4', 'ls': 'none', 'capsize':2, 'alpha': 1, 'label': 'VLT/SPHERE'},
+    'Paranal/SPHERE.IRDIS_D_H23_2': {'zorder':1,'marker': '', 'ms': 5., 'color': 'xkcd:dark orange', 'ls': 'none', 'capsize':2, 'label': 'VLT/SPHERE/IRDIS'},
+    'Paranal/SPHERE.IRDIS_D_H23_3': {'zorder':1,'marker': '', 'ms': 5., 'color': 'xkcd:dark orange', 'ls': 'none', 'capsize':2},
+    }
+
+# Wavelength range (um) of the spectrum figure
+SPECTRUM_XLIM = (0.95, 2.5)
+
+
+def config_hash(config):
+    """
+    Content hash of a configuration dictionary. The dictionary is
+    serialized as canonical JSON (sorted keys, tuples as lists) so
+    the hash does not depend on the order in the manifest.
+    """
+
+    canonical = json.dumps(config, sort_keys=True, separators=(',', ':'))
+
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _as_tuple(value):
+    # species expects tuples for boundaries and wavelength ranges
+    if isinstance(value, list):
+        return tuple(_as_tuple(item) for item in value)
+    return value
+
+
+class Variant:
+    """
+    One retrieval variant with its resolved configuration. The
+    ``key`` is the hash of the full configuration, including the
+    tag and the MultiNest output folder.
+    """
+
+    def __init__(self, tag, config, object_name):
+        self.tag = tag
+        self.config = config
+        self.object_name = object_name
+        self.output_folder = config['output_folder']
+        self.key = config_hash(config)
+
+    def __repr__(self):
+        return f'Variant({self.tag!r}, key={self.key[:12]})'
+
+    def retrieval_kwargs(self):
+        kwargs = {item: self.config[item] for item in RETRIEVAL_KEYS if item in self.config}
+        kwargs['wavel_range'] = _as_tuple(kwargs['wavel_range'])
+        return kwargs
+
+    def multinest_kwargs(self):
+        kwargs = {item: self.config[item] for item in MULTINEST_KEYS if item in self.config}
+        kwargs['bounds'] = {key: _as_tuple(value) for key, value in self.config['bounds'].items()}
+        kwargs['prior'] = {key: _as_tuple(value) for key, value in self.config['prior'].items()}
+        return kwargs
+
+
+class Manifest:
+    """
+    Parsed experiment manifest. Variants with an identical resolved
+    configuration are merged, and a tag that is used for two different
+    configurations raises an error.
+    """
+
+    def __init__(self, filename=MANIFEST):
+        with open(filename, 'rb') as toml_file:
+            manifest = tomllib.load(toml_file)
+
+        self.filename = filename
+        self.object_name = manifest['object']['name']
+        self.figures = manifest.get('figures', {})
+        self.benchmark = manifest.get('benchmark', {})
+
+        shared = manifest['retrieval']
+        self.stage = {item: shared[item] for item in STAGE_KEYS if item in shared}
+
+        self.variants = []
+        by_tag = {}
+
+        for entry in manifest.get('variant', []):
+            config = copy.deepcopy({key: value for key, value in shared.items()
+                                    if key not in STAGE_KEYS})
+
+            bounds = config.pop('bounds', {})
+            bounds.update(entry.get('bounds', {}))
+
+            config.update({key: value for key, value in entry.items()
+                           if key not in ('bounds', 'prior')})
+            config['bounds'] = bounds
+            config['prior'] = entry.get('prior', {})
+            config.setdefault('output_folder', entry['tag']+'-multinest')
+
+            variant = Variant(entry['tag'], config, self.object_name)
+
+            if variant.tag in by_tag:
+                if by_tag[variant.tag].key != variant.key:
+                    raise ValueError(f'The tag \'{variant.tag}\' is used for two different '
+                                     f'configurations in {filename}.')
+
+                print(f'Skipping duplicate variant in {filename}: {variant.tag}')
+                continue
+
+            by_tag[variant.tag] = variant
+            self.variants.append(variant)
+
+    def variant(self, tag):
+        for item in self.variants:
+            if item.tag == tag:
+                return item
+
+        raise ValueError(f'The tag \'{tag}\' is not found in {self.filename}.')
+
+
+class JobRegistry:
+    """
+    Keeps track of the jobs that have been executed in this process,
+    keyed on the job name and the hash of the variant configuration,
+    such that a repeated job returns the stored result.
+    """
+
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, variant, func, *args, **kwargs):
+        job_key = (name, variant.key)
+
+        if job_key in self.results:
+            print(f'Skipping {name} of {variant.tag}: already done in this run')
+            return self.results[job_key]
+
+        result = func(*args, **kwargs)
+        self.results[job_key] = result
+
+        return result
+
+
+def mpi_rank():
+    try:
+        from mpi4py import MPI
+        return MPI.COMM_WORLD.Get_rank()
+
+    except ModuleNotFoundError:
+        return 0
+
+
+def likelihood_patches(stage, variant, retrieval_kwargs):
+    """
+    Stage settings of a retrieval that change its likelihood. Shared
+    opacities and a pressure cache with tolerance 0 give identical
+    likelihoods, so they are not included.
+    """
+
+    pressure_cache = stage.get('pressure_cache', False) and retrieval_kwargs.get('pressure_grid') == 'clouds'
+
+    return {'operators': bool(stage.get('operators', False)),
+            'correlated_noise': bool(stage.get('correlated_noise', False) and variant.config.get('fit_corr')),
+            'chemistry_grid': bool(stage.get('chemistry_grid', False)
+                                   and variant.config.get('chemistry') == 'equilibrium'),
+            'pressure_tolerance': float(stage.get('pressure_tolerance', 0.)) if pressure_cache else 0.}
+
+
+def check_patches(variant, patches):
+    """
+    Store the likelihood patches of a retrieval in ``patches.json`` in
+    its output folder. A run that is resumed from MultiNest output
+    with other patches raises an error, since its live points were
+    sampled with another likelihood. Output without ``patches.json``
+    was written without any of the patches.
+    """
+
+    filename = os.path.join(variant.output_folder, 'patches.json')
+
+    if variant.config.get('resume', False) and \
+            os.path.exists(os.path.join(variant.output_folder, 'retrieval_ev.dat')):
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as json_file:
+                stored = json.load(json_file)
+        else:
+            stored = {key: 0. if key == 'pressure_tolerance' else False for key in patches}
+
+        if stored != patches:
+            raise ValueError(f'The retrieval of {variant.tag} is resumed with the likelihood '
+                             f'patches {patches}, but it was started with {stored}. Set these '
+                             f'options of the manifest as before, or set resume = false.')
+
+    if mpi_rank() == 0:
+        if not os.path.isdir(variant.output_folder):
+            os.makedirs(variant.output_folder)
+
+        # The other ranks may be reading the file, so it is replaced at once
+        with open(filename+'.tmp', 'w', encoding='utf-8') as json_file:
+            json.dump(patches, json_file, indent=4)
+
+        os.replace(filename+'.tmp', filename)
+
+
+def run_retrieval(variant, manifest=None):
+    """
+    Run the MultiNest retrieval of a variant with
+    species.AtmosphericRetrieval. With ``warm_start_from`` in the
+    manifest, the uniform priors are first pruned to the region that is
+    supported by the posterior of that (completed) variant. The pruned
+    boundaries and the log-volume correction for the evidence are
+    written to ``warm_start.json`` in the output folder. With
+    ``shared_opacities = true``, the MPI ranks of a node share their
+    opacity tables. With ``chemistry_grid = true``, the equilibrium
+    chemistry is interpolated from a precomputed grid. With
+    ``pressure_cache = true``, the refined pressure grids of
+    ``pressure_grid = 'clouds'`` are reused. With
+    ``operators = true``, the convolution, rebinning
+    and synthetic photometry use precomputed sparse operators. With
+    ``correlated_noise = true``, the covariance matrices of the spectra
+    in ``fit_corr`` are inverted with a cached Cholesky factorization. With
+    ``profile = true``, the likelihood is profiled and the report is
+    written to ``profile.txt`` in the output folder. A run is not resumed
+    with other patches that change the likelihood than it was started
+    with (see :func:`check_patches`).
+    """
+
+    retrieval_kwargs = variant.retrieval_kwargs()
+
+    if retrieval_kwargs['wavel_range'] == 'data':
+        # Note that log_tau_cloud is the cloud optical depth over this range
+        objectbox = species.Database().get_object(variant.object_name, inc_phot=True)
+        retrieval_kwargs['wavel_range'] = models.data_window(objectbox,
+                                                             margin=variant.config.get('window_margin', 4.))
+
+        print(f'Wavelength range of {variant.tag}: {retrieval_kwargs["wavel_range"]}')
+
+    retrieve = species.AtmosphericRetrieval(object_name=variant.object_name,
+                                            output_folder=variant.output_folder,
+                                            **retrieval_kwargs)
+
+    kwargs = variant.multinest_kwargs()
+
+    if 'warm_start_from' in variant.config and manifest is not None:
+        source = manifest.variant(variant.config['warm_start_from'])
+
+        if has_posterior(source.output_folder):
+            bounds, ln_volume_ratio = posteriors.prune_bounds(source.output_folder, kwargs['bounds'],
+                                                              margin=variant.config.get('warm_start_margin', 3.))
+
+            if mpi_rank() == 0:
+                if not os.path.isdir(variant.output_folder):
+                    os.makedirs(variant.output_folder)
+
+                with open(os.path.join(variant.output_folder, 'warm_start.json'), 'w', encoding='utf-8') as json_file:
+                    json.dump({'source': source.output_folder,
+                               'bounds': kwargs['bounds'],
+                               'pruned_bounds': bounds,
+                               # ln(Z) of the original prior volume = ln(Z_pruned) + ln_volume_ratio
+                               'ln_volume_ratio': ln_volume_ratio}, json_file, indent=4)
+
+            print(f'Warm start of {variant.tag} from {source.tag}: '
+                  f'ln(V_pruned/V_prior) = {ln_volume_ratio:.2f}')
+
+            kwargs['bounds'] = bounds
+
+        else:
+            print(f'The retrieval of {source.tag} has not finished, so {variant.tag} '
+                  f'starts from the full prior volume.')
+
+    stage = {} if manifest is None else manifest.stage
+
+    check_patches(variant, likelihood_patches(stage, variant, retrieval_kwargs))
+
+    with contextlib.ExitStack() as stack:
+        if stage.get('shared_opacities', False):
+            stack.enter_context(opacities.shared_opacities(stage.get('opacity_store_folder', '/dev/shm')))
+
+        if stage.get('chemistry_grid', False) and variant.config.get('chemistry') == 'equilibrium':
+            stack.enter_context(chemistry.chemistry_grid(method=stage.get('chemistry_interp', None),
+                                                         cache_file=stage.get('chemistry_cache_file', None),
+                                                         tolerance=stage.get('chemistry_tolerance', 0.01)))
+
+        if stage.get('pressure_cache', False) and retrieval_kwargs.get('pressure_grid') == 'clouds':
+            stack.enter_context(pressure.pressure_grid_cache(tolerance=stage.get('pressure_tolerance', 0.),
+                                                             max_size=stage.get('pressure_cache_size', 256)))
+
+        if stage.get('operators', False):
+            stack.enter_context(operators.instrument_operators(stage.get('operator_cache_folder', None)))
+
+        if stage.get('correlated_noise', False) and kwargs.get('fit_corr'):
+            stack.enter_context(covariance.retrieval_covariance(retrieve, kwargs['fit_corr'],
+                                                                min_size=stage.get('correlated_noise_min_size', 100)))
+
+        if stage.get('profile', False):
+            stack.enter_context(profile.profiling(variant.output_folder, rank=mpi_rank()))
+
+        retrieve.run_multinest(**kwargs)
+
+
+def has_posterior(output_folder):
+    """
+    Check if a MultiNest output folder contains posterior samples.
+    """
+
+    return any(os.path.exists(os.path.join(output_folder, item))
+               for item in ('retrieval_post_equal_weights.dat', 'post_equal_weights.dat'))
+
+
+def reweight_retrieval(manifest, variant, min_ess=1000):
+    """
+    Derive the posterior of a variant with ``reweight_from`` in the
+    manifest by importance reweighting the completed run of that tag
+    with the Gaussian priors of the variant. Returns ``True`` if the
+    variant does not need a full retrieval.
+    """
+
+    if 'reweight_from' not in variant.config:
+        return False
+
+    if os.path.exists(os.path.join(variant.output_folder, 'reweighting.json')):
+        print(f'The posterior of {variant.tag} has already been derived by reweighting.')
+        return True
+
+    if has_posterior(variant.output_folder):
+        # A full retrieval was started before, so it is resumed instead
+        return False
+
+    source = manifest.variant(variant.config['reweight_from'])
+
+    if not has_posterior(source.output_folder):
+        print(f'The retrieval of {source.tag} has not finished, so {variant.tag} '
+              f'can not be derived by reweighting.')
+        return False
+
+    extra_prior = {key: value for key, value in variant.config['prior'].items()
+                   if source.config['prior'].get(key) != value}
+
+    return posteriors.write_reweighted(source.output_folder, variant.output_folder,
+                                       extra_prior, min_ess=min_ess)
+
+
+def add_retrieval(database, variant, inc_teff=True, compact=False, chunk_rows=256, float32=False):
+    """
+    Add the MultiNest output of a variant to the species database. With
+    ``compact``, the posterior samples are rewritten as chunked and
+    compressed datasets with a resampling index, such that random
+    subsets only read the selected rows. The posterior gets a new
+    content id, which invalidates the subsets and figures of the
+    previous samples.
+    """
+
+    database.add_retrieval(tag=variant.tag,
+                           output_folder=variant.output_folder,
+                           inc_teff=inc_teff)
+
+    storage.mark_posterior(database.database, variant.tag)
+
+    if compact:
+        storage.compact_posterior(database.database, variant.tag,
+                                  chunk_rows=chunk_rows, float32=float32)
+
+
+def has_retrieval(database, tag):
+    """
+    Check if the posterior of a tag has been added to the database.
+    """
+
+    with h5py.File(database.database, 'r') as h5_file:
+        return f'results/fit/{tag}' in h5_file
+
+
+def report_partial(variant):
+    """
+    Print the progress of a retrieval that is still running, from the
+    stream file that is written by the comparison stage. Returns the
+    partial posterior (samples, weights, ln(Z)) or ``None``.
+    """
+
+    partial = stream.read_stream(variant.output_folder)
+
+    if partial is None or partial['dead'].shape[0] == 0:
+        print(f'{variant.tag} has not been added to the database and has no partial output.')
+        return None
+
+    samples, weights, ln_z = stream.partial_posterior(partial)
+
+    print(f'{variant.tag} is still running: {partial["dead"].shape[0]} dead points, '
+          f'ln(Z) = {ln_z:.2f}, ESS = {posteriors.effective_sample_size(weights):.1f}')
+
+    return samples, weights, ln_z
+
+
+def plot_variant(database, variant, figures, model_cache=None, force=False, renderer=None):
+    """
+    Create the posterior, P-T profile, opacity, contribution and
+    spectrum figures of a variant in the folder named after its tag.
+    A figure is only recreated if its inputs (posterior samples,
+    observations, model settings and plot arguments) have changed since
+    the last run, or with ``force``. The best-fit and cloud-free spectra
+    are computed through ``model_cache``, so identical models are only
+    computed once. Teff is derived from the posterior spectra of the
+    figure. With ``renderer`` (a ``RenderPool``), the figures that only
+    draw are rendered in worker processes, while the models are
+    computed in this process.
+    """
+
+    if model_cache is None:
+        model_cache = models.ModelCache()
+
+    tag = variant.tag
+
+    if not os.path.isdir('./'+tag):
+        os.makedirs('./'+tag)
+
+    # Rasterized figures differ from vector figures, so the settings are an input of all figures
+    figure_build = build.FigureBuild(tag, force=force,
+                                     common={item: figures.get(item, None) for item in
+                                             ('rasterize', 'rasterize_min_lines', 'raster_dpi')})
+
+    setup = models.RetrievalSetup(database.database, tag)
+
+    # The content id changes whenever the samples are written, so they are not read and hashed
+    posterior = {'samples': storage.content_id(database.database, tag),
+                 'parameters': list(setup.parameters)}
+
+    posterior_kwargs = {'offset': (-0.3, -0.35),
+                        'vmr': True,
+                        'inc_mass': True,
+                        'inc_pt_param': False}
+
+    output = tag+'/'+tag+'_posterior.pdf'
+
+    figure_build.build(output, {'posterior': posterior, 'plot': posterior_kwargs},
+                       _plot_posterior, tag, output, posterior_kwargs, pool=renderer)
+
+    objectbox = database.get_object(variant.object_name,
+                                    inc_phot=True)
+
+    observations = build.group_digest(database.database, f'objects/{variant.object_name}')
+
+    # The P-T, opacity and best-fit models use a Radtrans instance that
+    # is cached across tags. With wavel_range = 'data', the opacities are
+    # only loaded for the range of the observations and the spectrum figure
+    wavel_range = figures.get('wavel_range', [0.5, 6.])
+
+    if wavel_range == 'data':
+        wavel_range = models.data_window(objectbox,
+                                         spec_res=figures.get('spec_res', 500.),
+                                         margin=figures.get('window_margin', 4.),
+                                         extra=SPECTRUM_XLIM)
+
+    wavel_range = _as_tuple(wavel_range)
+
+    model = {'radtrans': setup.radtrans_kwargs(wavel_range),
+             'chemistry': setup.chemistry,
+             'pt_profile': setup.pt_profile,
+             'quenching': setup.quenching}
+
+    # The opacities are only loaded if a figure has to be recreated
+    def radtrans():
+        return models.get_radtrans(database, tag, wavel_range=wavel_range, setup=setup)
+
+    before_write = None if renderer is None else renderer.wait
+
+    best = database.get_probable_sample(tag=tag)
+
+    # get_model always computes the contribution function, so it is taken from
+    # the best-fit model of the contribution figure and stored in the database,
+    # and the best-fit spectrum is stored in the model cache for the spectrum figure
+    output = tag+'/'+tag+'_contribution.pdf'
+
+    figure_build.build(output, {'posterior': posterior, 'model': model},
+                       lambda: models.get_contribution(database, tag, radtrans(), best,
+                                                       plot_contribution=output,
+                                                       model_cache=model_cache,
+                                                       before_write=before_write))
+
+    # With photosphere = 'contribution', the photosphere axis and the
+    # contribution function of the P-T figure are derived from the stored
+    # contribution function instead of another radiative transfer by
+    # plot_pt_profile
+    photosphere = figures.get('photosphere', 'contribution')
+
+    pt_kwargs = {'random': figures.get('random_pt', 100),
+                 'xlim': (0., 6000.),
+                 'offset': (-0.07, -0.14),
+                 'extra_axis': 'photosphere' if photosphere == 'species' else None}
+
+    output = tag+'/'+tag+'_pt_profile.pdf'
+    inputs = {'posterior': posterior, 'model': model, 'plot': pt_kwargs, 'photosphere': photosphere}
+
+    # The Radtrans instance is created here, such that the workers share it
+    if figure_build.outdated(output, inputs):
+        read_rad = radtrans()
+        contribution = None
+
+        if photosphere == 'contribution':
+            contribution = models.get_contribution(database, tag, read_rad, best,
+                                                   model_cache=model_cache,
+                                                   before_write=before_write)
+
+        figure_build.build(output, inputs, _plot_pt_profile, tag, output, read_rad, pt_kwargs, contribution,
+                           pool=renderer)
+
+    opacity_kwargs = {'offset': (-0.1, -0.14)}
+
+    output = tag+'/'+tag+'_opacities.pdf'
+    inputs = {'posterior': posterior, 'model': model, 'plot': opacity_kwargs}
+
+    if figure_build.outdated(output, inputs):
+        figure_build.build(output, inputs,
+                           functools.partial(species.plot_opacities, tag=tag, output=output,
+                                             radtrans=radtrans(), **opacity_kwargs),
+                           pool=renderer)
+
+    envelope_samples = figures.get('envelope_samples', 0)
+
+    spectrum_kwargs = {'filters': None,
+                       'plot_kwargs': [envelopes.envelope_kwargs() if envelope_samples > 0 else
+                                       {'zorder':3,'ls': '-', 'lw': 0.1, 'color': 'gray'},
+                                       {'zorder':3,'ls': '-', 'lw': 0.5, 'color': 'black'},
+                                       {'zorder':3,'ls': '--', 'lw': 0.3, 'color': 'black'},
+                                       DATA_KWARGS],
+                       'xlim': SPECTRUM_XLIM,
+                       # 'ylim': (0.15e-16, 1.15e-15),
+                       'ylim_res': (-5., 5.),
+                       'scale': ('linear', 'linear'),
+                       'offset': (-0.6, -0.05),
+                       'figsize': (12, 6),
+                       'legend': [{'loc': 'upper right', 'fontsize': 8.}, {'loc': 'lower left', 'fontsize': 8.}]}
+
+    sampling = {item: figures.get(item, default) for item, default in
+                (('spec_res', 500.), ('random_teff', 30), ('random_spectra', 30),
+                 ('envelope_samples', 0), ('envelope_method', 'sketch'))}
+
+    def spectrum_boxes():
+        read_rad = radtrans()
+
+        # Teff and the posterior spectra are derived from the same samples, with
+        # one spectrum per sample over the Teff range (computed in a batch on a
+        # pool of workers), and are stored in the database for later runs
+        derived = models.derived_quantities(database, tag,
+                                            random=max(sampling['random_teff'], sampling['random_spectra']),
+                                            wavel_range=wavel_range,
+                                            spec_res=figures.get('spec_res', 500.),
+                                            n_workers=figures.get('n_workers', None),
+                                            before_write=before_write)
+
+        samples = derived.spectra(sampling['random_spectra']).boxes()
+
+        # With envelope_samples, the individual spectra are replaced by the
+        # median and 1 sigma / 2 sigma envelopes of many more samples
+        if envelope_samples > 0:
+            samples = models.posterior_envelope(database, tag,
+                                                random=envelope_samples,
+                                                wavel_range=wavel_range,
+                                                spec_res=figures.get('spec_res', 500.),
+                                                method=sampling['envelope_method'],
+                                                chunk_size=figures.get('envelope_chunk_size', 256),
+                                                n_workers=figures.get('n_workers', None)).boxes()
+
+        updated = species.update_spectra(objectbox, best)
+
+        # The best-fit spectrum is taken from the cache, such that the residuals
+        # (spectra and photometry) reuse it instead of running get_model again
+        modelbox = model_cache.get_model(read_rad, best, spec_res=figures.get('spec_res', 500.))
+
+        with model_cache.memoize(read_rad):
+            residuals = species.get_residuals(datatype='model',
+                                              spectrum='petitradtrans',
+                                              parameters=best,
+                                              objectbox=updated,
+                                              inc_phot=True,
+                                              inc_spec=True,
+                                              radtrans=read_rad)
+
+        # The cloud-free model is computed without cloud opacities and scattering,
+        # with the opacities of read_rad
+        no_clouds = best.copy()
+        no_clouds['log_tau_cloud'] = -100.
+        model_no_clouds = model_cache.get_model(read_rad, no_clouds, cloud_free=True)
+
+        return [samples, modelbox, model_no_clouds, updated], residuals
+
+    output = tag+'/'+tag+'_spectrum.pdf'
+    inputs = {'posterior': posterior, 'observations': observations, 'model': model,
+              'sampling': sampling, 'plot': spectrum_kwargs}
+
+    # The models are computed here and only the figure is rendered by a worker
+    if figure_build.outdated(output, inputs):
+        boxes, residuals = spectrum_boxes()
+
+        figure_build.build(output, inputs, _plot_spectrum, boxes, residuals, output, spectrum_kwargs,
+                           pool=renderer)
+
+
+def _plot_posterior(tag, output, kwargs):
+    try:
+        species.plot_posterior(tag=tag, output=output, **kwargs)
+    except:
+        pass
+
+
+def _plot_pt_profile(tag, output, read_rad, kwargs, contribution=None):
+    if contribution is None:
+        overlay = contextlib.nullcontext()
+    else:
+        # Without a Radtrans instance, plot_pt_profile does not run get_model,
+        # so the contribution function is drawn from the stored one
+        overlay = render.photosphere_axis(contribution.wavelength, contribution.photosphere(),
+                                          profile=(contribution.pressure, contribution.profile))
+        read_rad = None
+
+    with overlay:
+        species.plot_pt_profile(tag=tag,
+                                output=output,
+                                radtrans=read_rad,
+                                **kwargs)
+
+
+def _plot_spectrum(boxes, residuals, output, kwargs):
+    with envelopes.fill_envelopes():
+        species.plot_spectrum(boxes=boxes,
+                              residuals=residuals,
+                              output=output,
+                              **kwargs)
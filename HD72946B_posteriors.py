@@ -0,0 +1,230 @@
+################################################################################
+# Tools that derive posteriors from completed MultiNest runs instead of        #
+# running a new retrieval. The mass-prior variants only differ from the        #
+# no-mass-prior variants by the Gaussian prior on the mass (computed from      #
+# logg and radius), so their posterior and evidence can be obtained by         #
+# importance reweighting the weighted samples of the no-mass-prior run.        #
+# The prior volume of a new run can also be pruned to the region that is      #
+# supported by the posterior of a related run (warm start).                    #
+################################################################################
+import json
+import os
+import shutil
+
+import numpy as np
+
+from species.core import constants
+
+
+def read_multinest(output_folder):
+    """
+    Weighted posterior samples, log-likelihoods and the global
+    log-evidence of a MultiNest run by ``AtmosphericRetrieval``.
+    Returns the parameter names, the samples with shape
+    (n_samples, n_param), the posterior weights, the log-likelihoods
+    and the log-evidence with its uncertainty.
+    """
+
+    with open(os.path.join(output_folder, 'params.json'), encoding='utf-8') as json_file:
+        parameters = json.load(json_file)
+
+    # Columns: posterior weight, -2*ln(L), parameters
+    data = np.atleast_2d(np.loadtxt(os.path.join(output_folder, 'retrieval_.txt')))
+
+    ln_evidence = None
+
+    with open(os.path.join(output_folder, 'retrieval_stats.dat'), encoding='utf-8') as stats_file:
+        for line in stats_file:
+            if 'Global Log-Evidence' in line and 'Importance' not in line:
+                values = line.split(':')[1].split('+/-')
+                ln_evidence = (float(values[0]), float(values[1]))
+                break
+
+    if ln_evidence is None:
+        raise RuntimeError(f'Can not find the log-evidence in {output_folder}/retrieval_stats.dat.')
+
+    return parameters, data[:, 2:], data[:, 0], -0.5*data[:, 1], ln_evidence
+
+
+def get_mass(logg, radius):
+    """
+    Mass (Mjup) from the surface gravity (log10 cgs) and radius (Rjup),
+    as in ``species.util.read_util.get_mass`` but for arrays.
+    """
+
+    surface_grav = 1e-2*10.**logg  # (m s-2)
+    radius = radius*constants.R_JUP  # (m)
+
+    return surface_grav*radius**2/constants.GRAVITY/constants.M_JUP
+
+
+def prior_log_weights(parameters, samples, prior):
+    """
+    Logarithm of the Gaussian prior terms that ``run_multinest`` adds to
+    the log-likelihood for ``prior`` (e.g. ``{'mass': (69.5, 0.5)}``).
+    """
+
+    index = {item: i for i, item in enumerate(parameters)}
+    ln_weight = np.zeros(samples.shape[0])
+
+    for key, value in prior.items():
+        if key == 'mass':
+            param = get_mass(samples[:, index['logg']], samples[:, index['radius']])
+        else:
+            param = samples[:, index[key]]
+
+        ln_weight += -0.5*(param-value[0])**2/value[1]**2
+
+    return ln_weight
+
+
+def effective_sample_size(weights):
+    """
+    Kish effective sample size of importance weights.
+    """
+
+    return np.sum(weights)**2/np.sum(weights**2)
+
+
+def reweight(output_folder, prior):
+    """
+    Importance reweighting of a completed MultiNest run with additional
+    Gaussian priors. Since the uniform priors are unchanged, the new
+    posterior weights are the old weights times the prior terms, and
+    the evidence changes by the posterior mean of the prior terms:
+    ln(Z') = ln(Z) + ln(sum(w*g)/sum(w)). Returns a dictionary with the
+    parameters, samples, new weights and log-likelihoods, the new
+    log-evidence and the effective sample size.
+    """
+
+    parameters, samples, weights, ln_like, ln_evidence = read_multinest(output_folder)
+
+    ln_prior = prior_log_weights(parameters, samples, prior)
+
+    # Normalize with the maximum for numerical stability
+    ln_new = np.log(weights) + ln_prior
+    ln_max = np.amax(ln_new)
+    new_weights = np.exp(ln_new-ln_max)
+
+    ln_ratio = ln_max + np.log(np.sum(new_weights)) - np.log(np.sum(weights))
+
+    return {'parameters': parameters,
+            'samples': samples,
+            'weights': new_weights/np.sum(new_weights),
+            'ln_like': ln_like + ln_prior,
+            'ln_evidence': (ln_evidence[0]+ln_ratio, ln_evidence[1]),
+            'ess': effective_sample_size(new_weights)}
+
+
+def equal_weights(weights, n_samples, seed=None):
+    """
+    Indices of ``n_samples`` equally weighted samples, drawn with
+    systematic resampling.
+    """
+
+    rng = np.random.default_rng(seed)
+    positions = (rng.random() + np.arange(n_samples))/n_samples
+    cumulative = np.cumsum(weights)
+    cumulative[-1] = 1.
+
+    return np.searchsorted(cumulative, positions)
+
+
+def write_reweighted(source_folder, output_folder, prior, min_ess=1000, seed=None):
+    """
+    Create the output folder of a retrieval variant that only differs
+    from the completed run in ``source_folder`` by the Gaussian
+    ``prior``, by importance reweighting the MultiNest samples. The
+    folder has the same files that ``database.add_retrieval`` reads
+    (``params.json``, ``radtrans.json`` and the equally weighted
+    posterior samples) and a ``reweighting.json`` with the derived
+    log-evidence and effective sample size. Returns ``False`` without
+    writing anything if the effective sample size is smaller than
+    ``min_ess``, in which case a full retrieval is required.
+    """
+
+    result = reweight(source_folder, prior)
+
+    print(f'Reweighting {source_folder} with prior={prior}: '
+          f'ESS = {result["ess"]:.1f}, ln(Z) = {result["ln_evidence"][0]:.2f}')
+
+    if result['ess'] < min_ess:
+        print(f'The effective sample size is smaller than {min_ess}, '
+              f'so {output_folder} requires a full retrieval.')
+        return False
+
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+
+    for item in ('params.json', 'radtrans.json'):
+        shutil.copy(os.path.join(source_folder, item), os.path.join(output_folder, item))
+
+    indices = equal_weights(result['weights'], int(result['ess']), seed=seed)
+
+    np.savetxt(os.path.join(output_folder, 'retrieval_post_equal_weights.dat'),
+               np.column_stack([result['samples'][indices], result['ln_like'][indices]]))
+
+    with open(os.path.join(output_folder, 'reweighting.json'), 'w', encoding='utf-8') as json_file:
+        json.dump({'source': source_folder,
+                   'prior': {key: list(value) for key, value in prior.items()},
+                   'ln_evidence': list(result['ln_evidence']),
+                   'ess': result['ess'],
+                   'n_samples': int(indices.size)}, json_file, indent=4)
+
+    return True
+
+
+def read_equal_weights(output_folder):
+    """
+    Parameter names and equally weighted posterior samples (without the
+    log-likelihood column) of a MultiNest run.
+    """
+
+    with open(os.path.join(output_folder, 'params.json'), encoding='utf-8') as json_file:
+        parameters = json.load(json_file)
+
+    for item in ('retrieval_post_equal_weights.dat', 'post_equal_weights.dat'):
+        if os.path.exists(os.path.join(output_folder, item)):
+            samples = np.atleast_2d(np.loadtxt(os.path.join(output_folder, item)))
+            return parameters, samples[:, :-1]
+
+    raise RuntimeError(f'Can not find the post_equal_weights.dat file in {output_folder}.')
+
+
+def prune_bounds(source_folder, bounds, margin=3.):
+    """
+    Shrink the uniform prior boundaries to the range of the posterior
+    samples of a related, completed run, widened on both sides by
+    ``margin`` times the posterior standard deviation and limited to
+    the original boundaries. Only parameters with a (lower, upper)
+    boundary that are also sampled by the source run are pruned. As long
+    as the posterior mass outside the pruned volume is negligible, the
+    posterior is unchanged and the evidence of the original prior volume
+    follows from ln(Z) = ln(Z_pruned) + ln_volume_ratio. Returns the
+    pruned boundaries and ``ln_volume_ratio``, the logarithm of the ratio
+    of the pruned and the original prior volume.
+    """
+
+    parameters, samples = read_equal_weights(source_folder)
+
+    new_bounds = dict(bounds)
+    ln_volume_ratio = 0.
+
+    for i, item in enumerate(parameters):
+        value = bounds.get(item, None)
+
+        if not isinstance(value, tuple) or len(value) != 2 or \
+                not all(isinstance(limit, (int, float)) for limit in value) or value[0] >= value[1]:
+            continue
+
+        width = margin*float(np.std(samples[:, i]))
+        low = max(value[0], float(np.amin(samples[:, i]))-width)
+        high = min(value[1], float(np.amax(samples[:, i]))+width)
+
+        if low >= high:
+            continue
+
+        new_bounds[item] = (low, high)
+        ln_volume_ratio += np.log((high-low)/(value[1]-value[0]))
+
+    return new_bounds, float(ln_volume_ratio)
@@ -0,0 +1,163 @@
+################################################################################
+# Cache of the refined pressure grids of pressure_grid='clouds'. For every     #
+# likelihood call, calc_spectrum_clouds refines the pressure grid around the   #
+# cloud base pressures (make_half_pressure_better) and sets up the opacity     #
+# structure of Radtrans for the new grid. Late in the nested sampling, the     #
+# cloud bases of the live points are nearly identical, so the refined grids    #
+# are cached on the cloud base pressures and the opacity structure is only     #
+# set up again if the grid has changed. The pressures are quantized to a       #
+# tolerance (dex), which changes the likelihood. With a tolerance of 0 the     #
+# cache only checks correctness, since continuous samples practically never    #
+# repeat a cloud base pressure.                                                #
+################################################################################
+import collections
+import contextlib
+import importlib
+
+import numpy as np
+
+
+def _import(module_name):
+    try:
+        return importlib.import_module(module_name)
+
+    except ImportError:
+        return None
+
+
+class PressureGridCache:
+    """
+    LRU cache of refined pressure grids with ``max_size`` entries. The
+    cloud base pressures are rounded to ``tolerance`` dex, and the grid
+    is refined around the rounded pressures, such that the grid only
+    depends on the key. With ``tolerance=0``, a grid is only reused for
+    identical cloud base pressures, which does not change the likelihood
+    but practically never hits for continuous samples.
+    """
+
+    def __init__(self, tolerance=0., max_size=256):
+        self.tolerance = tolerance
+        self.max_size = max_size
+
+        self.grids = collections.OrderedDict()
+        self.patched = []
+
+        self.hits = 0
+        self.misses = 0
+        self.setups = 0
+        self.skipped = 0
+
+    def quantize(self, p_base):
+        """
+        Cloud base pressures rounded to the tolerance, as a hashable key
+        and in the format of ``p_base``.
+        """
+
+        items = p_base.items() if isinstance(p_base, dict) else enumerate(np.atleast_1d(p_base))
+
+        key = []
+        rounded = {}
+
+        for name, value in items:
+            if self.tolerance > 0.:
+                index = int(np.round(np.log10(value)/self.tolerance))
+                value = 10.**(index*self.tolerance)
+            else:
+                index = float(value)
+
+            key.append((name, index))
+            rounded[name] = value
+
+        if not isinstance(p_base, dict):
+            rounded = np.array([rounded[i] for i in range(len(rounded))])
+
+            if np.ndim(p_base) == 0:
+                rounded = rounded[0]
+
+        return tuple(key), rounded
+
+    def refine(self, func):
+        def make_half_pressure_better(p_base, pressure):
+            key, rounded = self.quantize(p_base)
+            key = (pressure.size, float(pressure[0]), float(pressure[-1]), key)
+
+            if key in self.grids:
+                self.grids.move_to_end(key)
+                self.hits += 1
+                return self.grids[key]
+
+            self.misses += 1
+
+            result = func(rounded, pressure)
+
+            self.grids[key] = result
+
+            if len(self.grids) > self.max_size:
+                self.grids.popitem(last=False)
+
+            return result
+
+        return make_half_pressure_better
+
+    def setup(self, func):
+        cache = self
+
+        def setup_opa_structure(self, P):
+            # The opacity structure only depends on the pressure grid. The
+            # grid is stored with the cache that set it up, since setups
+            # without the cache are not recorded
+            owner, previous = getattr(self, '_refined_pressure', (None, None))
+
+            if owner is cache and previous.shape == np.shape(P) and np.array_equal(previous, P):
+                cache.skipped += 1
+                return None
+
+            cache.setups += 1
+            self._refined_pressure = (cache, np.array(P, copy=True))
+
+            return func(self, P)
+
+        return setup_opa_structure
+
+    def _patch(self, owner, name, wrapper):
+        if owner is None or not callable(getattr(owner, name, None)):
+            return
+
+        original = getattr(owner, name)
+        self.patched.append((owner, name, original))
+        setattr(owner, name, wrapper(original))
+
+    def install(self):
+        self._patch(_import('species.util.retrieval_util'), 'make_half_pressure_better', self.refine)
+        self._patch(getattr(_import('petitRADTRANS.radtrans'), 'Radtrans', None), 'setup_opa_structure', self.setup)
+
+    def uninstall(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+
+        self.patched = []
+
+    def report(self):
+        n_calls = self.hits + self.misses
+
+        if n_calls > 0:
+            print(f'Pressure grid cache: {self.hits}/{n_calls} refined grids reused, '
+                  f'{self.skipped}/{self.skipped+self.setups} opacity structure setups skipped')
+
+
+@contextlib.contextmanager
+def pressure_grid_cache(tolerance=0., max_size=256):
+    """
+    Cache the refined pressure grids of the retrievals that run inside
+    the ``with`` block.
+    """
+
+    cache = PressureGridCache(tolerance=tolerance, max_size=max_size)
+    cache.install()
+
+    try:
+        yield cache
+
+    finally:
+        cache.uninstall()
+        cache.report()
@@ -0,0 +1,258 @@
+################################################################################
+# Opt-in profiling of the likelihood of AtmosphericRetrieval.run_multinest.    #
+# The functions that the likelihood calls (chemistry, P-T profile, pressure    #
+# refinement, Radtrans opacities and radiative transfer, convolution,          #
+# rebinning and synthetic photometry) are temporarily wrapped with timers.     #
+# The self time (excluding nested phases) and call count of each phase are     #
+# summed per likelihood evaluation, and percentiles over all evaluations are   #
+# written to profile.txt and profile.json in the output folder.                #
+################################################################################
+import contextlib
+import functools
+import importlib
+import json
+import os
+import time
+
+from array import array
+
+import numpy as np
+
+# (module, attribute, phase) of the functions that are timed. Functions
+# that are imported inside run_multinest are looked up at call time, so
+# patching the module attribute is sufficient
+FUNCTIONS = (
+    ('petitRADTRANS.poor_mans_nonequ_chem.poor_mans_nonequ_chem', 'interpol_abundances', 'chemistry'),
+    ('petitRADTRANS.poor_mans_nonequ_chem', 'interpol_abundances', 'chemistry'),
+    ('species.util.retrieval_util', 'interpol_abundances', 'chemistry'),
+    ('species.util.retrieval_util', 'pt_ret_model', 'pt_profile'),
+    ('species.util.retrieval_util', 'pt_spline_interp', 'pt_profile'),
+    ('species.util.retrieval_util', 'make_half_pressure_better', 'pressure_refinement'),
+    ('species.util.retrieval_util', 'calc_spectrum_clouds', 'spectrum'),
+    ('species.util.retrieval_util', 'calc_spectrum_clear', 'spectrum'),
+    ('species.util.retrieval_util', 'convolve', 'convolution'),
+    ('petitRADTRANS.retrieval.rebin_give_width', 'rebin_give_width', 'rebinning'),
+)
+
+# (class, method, phase) of the Radtrans and photometry methods that are timed
+METHODS = (
+    ('petitRADTRANS.radtrans', 'Radtrans', 'setup_opa_structure', 'pressure_refinement'),
+    ('petitRADTRANS.radtrans', 'Radtrans', 'interpolate_species_opa', 'line_opacity'),
+    ('petitRADTRANS.radtrans', 'Radtrans', 'mix_opa_tot', 'line_opacity'),
+    ('petitRADTRANS.radtrans', 'Radtrans', 'calc_cloud_opacity', 'cloud_opacity'),
+    ('petitRADTRANS.radtrans', 'Radtrans', 'calc_opt_depth', 'optical_depth'),
+    ('petitRADTRANS.radtrans', 'Radtrans', 'calc_RT', 'radiative_transfer'),
+    ('petitRADTRANS.radtrans', 'Radtrans', 'calc_flux', 'radiative_transfer'),
+    ('species.analysis.photometry', 'SyntheticPhotometry', 'spectrum_to_flux', 'photometry'),
+    ('species', 'SyntheticPhotometry', 'spectrum_to_flux', 'photometry'),
+)
+
+
+def _import(module_name):
+    try:
+        return importlib.import_module(module_name)
+
+    except ImportError:
+        return None
+
+
+class LikelihoodProfiler:
+    """
+    Timers for the phases of the likelihood. A phase is only timed
+    while a likelihood evaluation is running, and its self time
+    excludes the time spent in nested phases (e.g. the chemistry
+    inside ``calc_spectrum_clouds``). The remaining time of the
+    likelihood itself (e.g. the covariance matrices of ``fit_corr``)
+    is recorded as ``likelihood``.
+    """
+
+    def __init__(self):
+        self.patched = []
+        self.stack = []
+        self.active = False
+
+        self.current = {}
+        self.times = {}
+        self.counts = {}
+        self.n_like = 0
+
+    def wrap(self, phase, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.active:
+                return func(*args, **kwargs)
+
+            self.stack.append(0.)
+            start = time.perf_counter()
+
+            try:
+                return func(*args, **kwargs)
+
+            finally:
+                elapsed = time.perf_counter() - start
+                child = self.stack.pop()
+
+                if self.stack:
+                    self.stack[-1] += elapsed
+
+                item = self.current.setdefault(phase, [0., 0])
+                item[0] += elapsed - child
+                item[1] += 1
+
+        return wrapper
+
+    def wrap_likelihood(self, func):
+        timed = self.wrap('likelihood', func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.active = True
+
+            try:
+                return timed(*args, **kwargs)
+
+            finally:
+                self.active = False
+                self._flush()
+
+        return wrapper
+
+    def _flush(self):
+        for phase in self.current:
+            if phase not in self.times:
+                # Phases that were not called before contribute zero time
+                self.times[phase] = array('d', [0.]*self.n_like)
+                self.counts[phase] = array('l', [0]*self.n_like)
+
+        for phase in self.times:
+            item = self.current.get(phase, (0., 0))
+            self.times[phase].append(item[0])
+            self.counts[phase].append(item[1])
+
+        self.current = {}
+        self.n_like += 1
+
+    def _patch(self, owner, name, phase):
+        if any(item[0] is owner and item[1] == name for item in self.patched):
+            return
+
+        original = getattr(owner, name)
+        self.patched.append((owner, name, original))
+        setattr(owner, name, self.wrap(phase, original))
+
+    def install(self):
+        """
+        Wrap the likelihood (through ``pymultinest.run``) and the
+        phases that can be found in the installed species and
+        petitRADTRANS versions.
+        """
+
+        for module_name, name, phase in FUNCTIONS:
+            module = _import(module_name)
+
+            if module is not None and callable(getattr(module, name, None)):
+                self._patch(module, name, phase)
+
+        # Functions that the retrieval module imported by name
+        retrieval = _import('species')
+
+        if retrieval is not None and hasattr(retrieval, 'AtmosphericRetrieval'):
+            retrieval = _import(retrieval.AtmosphericRetrieval.__module__)
+
+            for module_name, name, phase in FUNCTIONS:
+                if callable(getattr(retrieval, name, None)):
+                    self._patch(retrieval, name, phase)
+
+        for module_name, class_name, name, phase in METHODS:
+            owner = getattr(_import(module_name), class_name, None)
+
+            if owner is not None and callable(getattr(owner, name, None)):
+                self._patch(owner, name, phase)
+
+        pymultinest = _import('pymultinest')
+
+        if pymultinest is not None:
+            run = pymultinest.run
+
+            @functools.wraps(run)
+            def run_profiled(LogLikelihood, *args, **kwargs):
+                return run(self.wrap_likelihood(LogLikelihood), *args, **kwargs)
+
+            self.patched.append((pymultinest, 'run', run))
+            pymultinest.run = run_profiled
+
+    def uninstall(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+
+        self.patched = []
+
+    def summary(self):
+        """
+        Per-phase statistics over all likelihood evaluations: the mean
+        number of calls, the mean and percentiles of the self time (ms)
+        and the fraction of the total time.
+        """
+
+        total = sum(np.sum(item) for item in self.times.values())
+        summary = {}
+
+        for phase, times in self.times.items():
+            times = 1e3*np.asarray(times)
+
+            summary[phase] = {'calls': float(np.mean(self.counts[phase])),
+                              'mean': float(np.mean(times)),
+                              'p50': float(np.percentile(times, 50.)),
+                              'p90': float(np.percentile(times, 90.)),
+                              'p99': float(np.percentile(times, 99.)),
+                              'fraction': float(1e-3*np.sum(times)/total) if total > 0. else 0.}
+
+        return dict(sorted(summary.items(), key=lambda item: -item[1]['fraction']))
+
+    def report(self, output_folder, rank=0):
+        """
+        Write profile.txt and profile.json (with a rank suffix for
+        MPI ranks other than 0) to the output folder.
+        """
+
+        if self.n_like == 0:
+            return
+
+        summary = self.summary()
+        suffix = '' if rank == 0 else f'_rank{rank}'
+
+        lines = [f'Likelihood profile of {self.n_like} evaluations (self time per evaluation in ms)',
+                 f'{"phase":<22}{"calls":>8}{"mean":>10}{"p50":>10}{"p90":>10}{"p99":>10}{"fraction":>10}']
+
+        for phase, item in summary.items():
+            lines.append(f'{phase:<22}{item["calls"]:>8.1f}{item["mean"]:>10.2f}{item["p50"]:>10.2f}'
+                         f'{item["p90"]:>10.2f}{item["p99"]:>10.2f}{item["fraction"]:>10.3f}')
+
+        with open(os.path.join(output_folder, f'profile{suffix}.txt'), 'w', encoding='utf-8') as txt_file:
+            txt_file.write('\n'.join(lines)+'\n')
+
+        with open(os.path.join(output_folder, f'profile{suffix}.json'), 'w', encoding='utf-8') as json_file:
+            json.dump({'n_likelihood': self.n_like, 'phases': summary}, json_file, indent=4)
+
+        if rank == 0:
+            print('\n'.join(lines))
+
+
+@contextlib.contextmanager
+def profiling(output_folder, rank=0):
+    """
+    Profile the likelihood of the retrievals that run inside the
+    ``with`` block and write the report to ``output_folder``.
+    """
+
+    profiler = LikelihoodProfiler()
+    profiler.install()
+
+    try:
+        yield profiler
+
+    finally:
+        profiler.uninstall()
+
+        if os.path.isdir(output_folder):
+            profiler.report(output_folder, rank=rank)
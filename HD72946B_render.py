@@ -0,0 +1,209 @@
+################################################################################
+# Headless and parallel rendering of the figures. Figures that only draw       #
+# (posterior, P-T profile, opacities and the spectrum with precomputed         #
+# models) are rendered in forked worker processes with the non-interactive     #
+# Agg backend, such that they share the Radtrans instances of the parent       #
+# without pickling. Dense overlays (the posterior sample spectra, P-T curves   #
+# and scatter clouds) are rasterized when a figure is saved, while the axes,   #
+# labels and the data remain vector graphics in the PDF.                       #
+################################################################################
+import collections
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+import os
+import warnings
+
+import numpy as np
+
+
+def headless():
+    """
+    Select the non-interactive Agg backend, if no backend was chosen
+    with MPLBACKEND. Should be called before pyplot is imported.
+    """
+
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+
+def _style(line):
+    return (str(line.get_color()), line.get_linewidth(), line.get_linestyle(), line.get_alpha())
+
+
+def rasterize_dense(fig, min_lines=20, min_points=5000):
+    """
+    Rasterize the overlays of the axes of ``fig``: groups of at least
+    ``min_lines`` lines with the same style (e.g. posterior samples)
+    and marker-only lines with at least ``min_points`` points (e.g. the
+    samples of a corner plot). Returns the number of rasterized artists.
+    """
+
+    from matplotlib import collections as mcollections
+
+    count = 0
+
+    for ax in fig.axes:
+        groups = collections.defaultdict(list)
+
+        for line in ax.get_lines():
+            if line.get_linestyle() in ('None', '', ' ') and len(line.get_xdata()) >= min_points:
+                line.set_rasterized(True)
+                count += 1
+
+            else:
+                groups[_style(line)].append(line)
+
+        for lines in groups.values():
+            if len(lines) >= min_lines:
+                for line in lines:
+                    line.set_rasterized(True)
+
+                count += len(lines)
+
+        for item in ax.collections:
+            if isinstance(item, mcollections.LineCollection) and len(item.get_segments()) >= min_lines:
+                item.set_rasterized(True)
+                count += 1
+
+    return count
+
+
+@contextlib.contextmanager
+def rasterized_overlays(min_lines=20, min_points=5000, dpi=300):
+    """
+    Rasterize the dense overlays of the figures that are saved inside
+    the ``with`` block, at a resolution of ``dpi`` for the rasterized
+    parts.
+    """
+
+    from matplotlib import figure
+
+    original = figure.Figure.savefig
+
+    def savefig(self, *args, **kwargs):
+        if rasterize_dense(self, min_lines=min_lines, min_points=min_points) > 0:
+            kwargs.setdefault('dpi', dpi)
+
+        return original(self, *args, **kwargs)
+
+    figure.Figure.savefig = savefig
+
+    try:
+        yield
+
+    finally:
+        figure.Figure.savefig = original
+
+
+@contextlib.contextmanager
+def photosphere_axis(wavelength, pressure, profile=None, color='tab:blue'):
+    """
+    Add the photosphere pressure as a function of wavelength, on a
+    wavelength axis at the top, to the first axes (the P-T profile) of
+    the figures that are saved inside the ``with`` block. This replaces
+    the 'photosphere' extra axis of ``plot_pt_profile`` with a
+    precomputed contribution function. With ``profile`` (the pressures
+    in bar and the mean contribution function), the contribution
+    function is also drawn as dashed line, as ``plot_pt_profile`` does
+    when it is given a Radtrans instance.
+    """
+
+    from matplotlib import figure
+
+    original = figure.Figure.savefig
+
+    def savefig(self, *args, **kwargs):
+        if self.axes and not getattr(self, '_photosphere_axis', False):
+            if profile is not None:
+                xlim = self.axes[0].get_xlim()
+                contr_1d = xlim[0] + 0.5*(profile[1]/np.amax(profile[1]))*(xlim[1]-xlim[0])
+
+                self.axes[0].plot(contr_1d, profile[0], ls='--', lw=0.5, color='black')
+
+            ax = self.axes[0].twiny()
+            ax.plot(wavelength, pressure, color=color, lw=0.5, alpha=0.7)
+            ax.set_xlim(np.amin(wavelength), np.amax(wavelength))
+            ax.set_xlabel('Wavelength (µm)', fontsize=13, color=color)
+            ax.tick_params(axis='x', colors=color)
+
+            self._photosphere_axis = True
+
+        return original(self, *args, **kwargs)
+
+    figure.Figure.savefig = savefig
+
+    try:
+        yield
+
+    finally:
+        figure.Figure.savefig = original
+
+
+def _render(func):
+    from matplotlib import pyplot as plt
+
+    func()
+
+    plt.close('all')
+
+
+class RenderPool:
+    """
+    Runs up to ``n_workers`` rendering functions at the same time, each
+    in a forked process that inherits the state of the parent (e.g. the
+    cached Radtrans instances and the computed models). Functions only
+    need to write their output file. The callback of a function is
+    called in the parent after it finished successfully. Without fork
+    or with ``n_workers=1``, the functions are called directly.
+    """
+
+    def __init__(self, n_workers=None):
+        if n_workers is None:
+            n_workers = os.cpu_count()
+
+        self.n_workers = n_workers
+        self.parallel = n_workers > 1 and 'fork' in multiprocessing.get_all_start_methods()
+        self.active = []
+
+    def submit(self, name, func, callback=None):
+        if not self.parallel:
+            _render(func)
+
+            if callback is not None:
+                callback()
+
+            return
+
+        while len(self.active) >= self.n_workers:
+            self._reap()
+
+        process = multiprocessing.get_context('fork').Process(target=_render, args=(func,), name=name)
+        process.start()
+
+        self.active.append((process, callback))
+
+    def _reap(self):
+        # Wait for the first process that finishes
+        multiprocessing.connection.wait([item[0].sentinel for item in self.active])
+
+        for process, callback in list(self.active):
+            if process.is_alive():
+                continue
+
+            process.join()
+            self.active.remove((process, callback))
+
+            if process.exitcode != 0:
+                warnings.warn(f'Rendering {process.name} failed with exit code {process.exitcode}.')
+
+            elif callback is not None:
+                callback()
+
+    def wait(self):
+        """
+        Wait until all submitted functions have finished, e.g. before
+        the parent writes to a file that the workers read.
+        """
+
+        while self.active:
+            self._reap()
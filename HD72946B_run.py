@@ -0,0 +1,144 @@
+################################################################################
+# Single entry point for the three stages, which run in one process with      #
+# shared state (see HD72946B_stages.py):                                       #
+#                                                                              #
+#   python HD72946B_run.py all [--cores N]    ingestion, retrievals, figures   #
+#   python HD72946B_run.py figures --tag HD72946B-am-molliere-nomass-freeab    #
+#   python HD72946B_run.py serve [--fifo jobs.fifo]                            #
+#                                                                              #
+# In serve mode, the process reads one job per line (e.g. "figures --tag       #
+# HD72946B-am-molliere-nomass-freeab --force") from stdin or from a named      #
+# pipe, and keeps the imported modules, the database and the cached models     #
+# between the jobs.                                                            #
+################################################################################
+import argparse
+import os
+os.environ["HDF5_USE_FILE_LOCKING"] = "FALSE"
+import shlex
+import sys
+import traceback
+
+import HD72946B_render as render
+
+# The figures are only written to files, so pyplot does not need a display
+render.headless()
+
+import HD72946B_stages as stages
+
+
+def job_parser(serve=True):
+    """
+    Parser of the command line and of the jobs in serve mode.
+    """
+
+    parser = argparse.ArgumentParser(description='Run the stages of the HD 72946 B retrievals in one process.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest = subparsers.add_parser('ingest', help='add the observations that have changed to the database')
+    ingest.add_argument('--force', action='store_true', help='add all observations again')
+
+    add = subparsers.add_parser('add', help='run and/or add the retrievals to the database')
+    figures = subparsers.add_parser('figures', help='create the figures of the retrievals')
+    run_all = subparsers.add_parser('all', help='ingestion, retrievals and figures')
+
+    for item in (add, figures, run_all):
+        item.add_argument('--tag', action='append', help='only process this variant (can be repeated)')
+
+    for item in (add, run_all):
+        item.add_argument('--cores', type=int, default=None,
+                          help='run the retrievals concurrently within this core budget')
+        item.add_argument('--no-stream', action='store_true',
+                          help='do not stream the partial MultiNest output of parallel runs')
+
+    for item in (figures, run_all):
+        item.add_argument('--force', action='store_true',
+                          help='recreate all figures, also if their inputs have not changed')
+
+    if serve:
+        server = subparsers.add_parser('serve', help='read jobs from stdin or a named pipe, one per line')
+        server.add_argument('--fifo', default=None,
+                            help='named pipe to read the jobs from (created if it does not exist)')
+
+    return parser
+
+
+def run_job(session, args):
+    session.new_job()
+
+    if args.command in ('ingest', 'all'):
+        session.ingest(force=args.force if args.command == 'ingest' else False)
+
+    if args.command in ('add', 'all'):
+        session.add_retrievals(args.tag, cores=args.cores, stream=not args.no_stream)
+
+    if args.command in ('figures', 'all'):
+        session.figures(args.tag, force=args.force)
+
+
+def fifo_lines(filename):
+    """
+    Lines that are written to a named pipe, by any number of writers
+    after each other.
+    """
+
+    if not os.path.exists(filename):
+        os.mkfifo(filename)
+
+    while True:
+        # Blocks until a writer opens the pipe, and ends when it closes it
+        with open(filename, 'r', encoding='utf-8') as fifo:
+            yield from fifo
+
+
+def serve(session, lines):
+    """
+    Run the jobs in ``lines`` until the input ends or a line is 'quit'.
+    A job that fails is reported and the next job is read.
+    """
+
+    parser = job_parser(serve=False)
+
+    for line in lines:
+        words = shlex.split(line, comments=True)
+
+        if not words:
+            continue
+
+        if words[0] in ('quit', 'exit'):
+            break
+
+        try:
+            run_job(session, parser.parse_args(words))
+
+        except SystemExit:
+            # argparse has printed the error or the help
+            pass
+
+        except Exception:
+            traceback.print_exc()
+
+        print(f'Done: {line.strip()}', flush=True)
+
+
+if __name__ == '__main__':
+    args = job_parser().parse_args()
+
+    session = stages.Session()
+
+    if args.command == 'serve':
+        if args.fifo is None:
+            print('Reading jobs from stdin', flush=True)
+            serve(session, sys.stdin)
+
+        else:
+            print(f'Reading jobs from {args.fifo}', flush=True)
+            serve(session, fifo_lines(args.fifo))
+
+    else:
+        run_job(session, args)
+
+    session.close()
+
+#############
+### Done! ###
+#############
@@ -0,0 +1,123 @@
+################################################################################
+# Local scheduler for the comparison stage. The MultiNest retrievals of the    #
+# variants are CPU-bound and independent, so a core budget is split across    #
+# the variants (and across MPI ranks within a variant) and the retrievals run  #
+# as concurrent child processes, each with its own log file and exit status.   #
+################################################################################
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+COMPARISON_SCRIPT = 'HD72946B_final_retrieval_comparison.py'
+
+
+def split_cores(n_cores, n_jobs):
+    """
+    Split a core budget across jobs. Every job gets at least one core
+    and the remainder is given to the first jobs, so with 16 cores and
+    4 variants each retrieval runs with 4 MPI ranks. With fewer cores
+    than jobs, each job gets a single core and the jobs are queued.
+    """
+
+    if n_jobs == 0:
+        return []
+
+    n_cores = max(n_cores, 1)
+    per_job, remainder = divmod(n_cores, n_jobs)
+
+    if per_job == 0:
+        return [1]*n_jobs
+
+    return [per_job + (1 if i < remainder else 0) for i in range(n_jobs)]
+
+
+def mpi_command(n_ranks, mpi_exec=None):
+    """
+    Command prefix for running with ``n_ranks`` MPI ranks. No prefix
+    is used for a single rank or if no MPI launcher is found.
+    """
+
+    if n_ranks < 2:
+        return []
+
+    if mpi_exec is None:
+        mpi_exec = shutil.which('mpirun') or shutil.which('mpiexec')
+
+    if mpi_exec is None:
+        print('No MPI launcher found, running each retrieval with a single process.')
+        return []
+
+    return [mpi_exec, '-n', str(n_ranks)]
+
+
+def retrieval_command(tag, n_ranks, mpi_exec=None):
+    """
+    Command for running the retrieval of a single variant with the
+    comparison script.
+    """
+
+    return mpi_command(n_ranks, mpi_exec) + [sys.executable, COMPARISON_SCRIPT,
+                                             '--tag', tag, '--retrieval-only']
+
+
+def run_parallel(variants, n_cores=None, log_folder='logs', mpi_exec=None, poll=10.,
+                 on_poll=None):
+    """
+    Run the retrievals of the variants concurrently within a budget of
+    ``n_cores`` cores. The output of each variant is written to
+    ``log_folder/<tag>.log``. The optional ``on_poll`` function is
+    called with the running tags at every poll (e.g. to ingest partial
+    results). Returns a dictionary with the exit status of each tag.
+    """
+
+    if n_cores is None:
+        n_cores = os.cpu_count()
+
+    if not os.path.isdir(log_folder):
+        os.makedirs(log_folder)
+
+    ranks = split_cores(n_cores, len(variants))
+    pending = list(zip(variants, ranks))
+    running = {}
+    status = {}
+
+    # Each rank should use one core, so avoid oversubscription by BLAS threads
+    env = os.environ.copy()
+    env.setdefault('OMP_NUM_THREADS', '1')
+
+    start = time.time()
+
+    while pending or running:
+        free = n_cores - sum(item[1] for item in running.values())
+
+        while pending and pending[0][1] <= max(free, 0):
+            variant, n_ranks = pending.pop(0)
+            command = retrieval_command(variant.tag, n_ranks, mpi_exec)
+            log_file = open(os.path.join(log_folder, variant.tag+'.log'), 'w')
+
+            print(f'Starting {variant.tag} with {n_ranks} core(s): {" ".join(command)}')
+
+            process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, env=env)
+            running[variant.tag] = (process, n_ranks, log_file)
+            free -= n_ranks
+
+        for tag in list(running):
+            process, _, log_file = running[tag]
+
+            if process.poll() is not None:
+                log_file.close()
+                status[tag] = process.returncode
+                del running[tag]
+
+                print(f'Finished {tag} with exit status {process.returncode} '
+                      f'after {(time.time()-start)/3600.:.2f} h')
+
+        if on_poll is not None:
+            on_poll(list(running))
+
+        if running:
+            time.sleep(poll)
+
+    return status
@@ -0,0 +1,262 @@
+################################################################################
+# The three stages (ingestion, retrievals and figures) as methods of one       #
+# session, such that they can run in a single long-lived process. species,     #
+# petitRADTRANS and the pipeline modules are only imported when a stage needs  #
+# them. The species database, the manifest, the cached Radtrans instances,     #
+# the model cache and the render workers are kept between the stages and      #
+# between the jobs of HD72946B_run.py serve, so e.g. re-plotting a single tag  #
+# does not pay the startup costs again. The stage scripts are thin wrappers    #
+# around this module.                                                          #
+################################################################################
+import contextlib
+import os
+
+import HD72946B_render as render
+
+OBJECT_NAME = 'HD 72946 B'
+
+# Observations of the object, as arguments of HD72946B_ingest.add_object
+OBSERVATIONS = {
+    'parallax': (38.9809,0.0412), #gaia edr3
+    'photometry': ('HD72946_SPHEREH_fluxcal_photometry_revised.dat',
+                   ['Paranal/SPHERE.IRDIS_D_H23_2',
+                    'Paranal/SPHERE.IRDIS_D_H23_3']),
+    'spectrum': {'SPHERE':('HD72946_SPHEREYJ_fluxcal_spectrum_revised.dat', None, 50.),
+                 'GRAVITY':(
+                            'HD72946B_GRAVITYK_fluxcal_spectrum_combined_cropped.fits',
+                            'HD72946B_GRAVITYK_fluxcal_spectrum_combined_cropped.fits',
+                            500.)},
+    }
+
+
+class Session:
+    """
+    State that is shared by the stages of one process. The manifest is
+    read again when its file has changed. The jobs that have been
+    executed are remembered until :meth:`new_job`, which is called for
+    each request in serve mode such that a tag can be plotted again.
+    """
+
+    def __init__(self, manifest_file=None):
+        self.manifest_file = manifest_file
+        self._manifest = None
+        self._manifest_mtime = None
+        self._database = None
+        self._jobs = None
+        self._model_cache = None
+        self._renderer = None
+
+    @property
+    def database(self):
+        if self._database is None:
+            import species
+
+            species.SpeciesInit()
+
+            self._database = species.Database()
+
+        return self._database
+
+    @property
+    def manifest(self):
+        import HD72946B_pipeline as pipeline
+
+        filename = pipeline.MANIFEST if self.manifest_file is None else self.manifest_file
+        mtime = os.path.getmtime(filename)
+
+        if self._manifest is None or mtime != self._manifest_mtime:
+            self._manifest = pipeline.Manifest(filename)
+            self._manifest_mtime = mtime
+
+        return self._manifest
+
+    @property
+    def jobs(self):
+        if self._jobs is None:
+            import HD72946B_pipeline as pipeline
+
+            self._jobs = pipeline.JobRegistry()
+
+        return self._jobs
+
+    def new_job(self):
+        """
+        Forget the jobs that have been executed, while keeping the
+        imported modules, the database and the cached models.
+        """
+
+        self._jobs = None
+
+    def model_cache(self, figures):
+        import HD72946B_models as models
+
+        folder = figures.get('model_cache_folder', None)
+
+        if self._model_cache is None or self._model_cache.cache_folder != folder:
+            self._model_cache = models.ModelCache(folder)
+
+        return self._model_cache
+
+    def renderer(self, figures):
+        n_workers = figures.get('render_workers', 1)
+
+        if self._renderer is None or self._renderer.n_workers != n_workers:
+            if self._renderer is not None:
+                self._renderer.wait()
+
+            self._renderer = render.RenderPool(n_workers)
+
+        return self._renderer
+
+    def variants(self, manifest, tags=None):
+        """
+        Variants of the manifest, only those of ``tags`` if given. An
+        unknown tag raises an error.
+        """
+
+        if tags is None:
+            return list(manifest.variants)
+
+        selected = {manifest.variant(tag).tag for tag in tags}
+
+        return [item for item in manifest.variants if item.tag in selected]
+
+    def ingest(self, force=False):
+        """
+        Add the observations that have changed to the database. Returns
+        the names of the items that were added.
+        """
+
+        import HD72946B_ingest as ingest
+
+        return ingest.add_object(self.database, OBJECT_NAME, force=force, **OBSERVATIONS)
+
+    def run_retrievals(self, tags=None):
+        """
+        Run the retrievals in this process, which is how the scheduler
+        runs each variant (with one process per MPI rank).
+        """
+
+        import HD72946B_pipeline as pipeline
+
+        manifest = self.manifest
+
+        for variant in self.variants(manifest, tags):
+            self.jobs.run('retrieval', variant,
+                          pipeline.run_retrieval, variant, manifest)
+
+    def add_retrievals(self, tags=None, cores=None, stream=True):
+        """
+        Run the retrievals (if ``run = true`` in the manifest or with
+        ``cores``) and add the posteriors to the database. With ``cores``,
+        the retrievals run concurrently within that core budget and
+        their partial output is streamed, unless ``stream=False``.
+        """
+
+        import HD72946B_pipeline as pipeline
+
+        manifest = self.manifest
+        variants = self.variants(manifest, tags)
+
+        database = self.database
+
+        min_ess = manifest.stage.get('min_ess', 1000)
+
+        if cores is not None:
+            import HD72946B_scheduler as scheduler
+            import HD72946B_stream as streaming
+
+            # Run the retrievals in parallel and only add the successful ones. The
+            # variants that can be derived by reweighting wait for their source run.
+            # The partial output is streamed to a SWMR file of each variant (the
+            # single writer is this process), so the figure stage can follow it.
+            # Ingesters are only created for the variants that run MultiNest, so
+            # reweighted variants get no stream file
+            folders = {item.tag: item.output_folder for item in variants}
+            ingesters = {}
+
+            def ingest(running):
+                if stream:
+                    for tag in running:
+                        if tag not in ingesters:
+                            ingesters[tag] = streaming.StreamIngester(folders[tag])
+
+                        ingesters[tag].update()
+
+            status = scheduler.run_parallel([item for item in variants if 'reweight_from' not in item.config],
+                                            n_cores=cores, on_poll=ingest)
+
+            remaining = [item for item in variants if 'reweight_from' in item.config
+                         and not self.jobs.run('reweight', item, pipeline.reweight_retrieval,
+                                               manifest, item, min_ess=min_ess)]
+
+            status.update(scheduler.run_parallel(remaining, n_cores=cores, on_poll=ingest))
+
+            for ingester in ingesters.values():
+                ingester.close()
+
+            variants = [item for item in variants if status.get(item.tag, 0) == 0]
+
+        for variant in variants:
+
+            if cores is None and manifest.stage.get('run', False):
+                if not self.jobs.run('reweight', variant, pipeline.reweight_retrieval,
+                                     manifest, variant, min_ess=min_ess):
+                    self.jobs.run('retrieval', variant,
+                                  pipeline.run_retrieval, variant, manifest)
+
+            self.jobs.run('add_retrieval', variant,
+                          pipeline.add_retrieval, database, variant,
+                          inc_teff=manifest.stage.get('inc_teff', True),
+                          compact=manifest.stage.get('compact_posterior', False),
+                          chunk_rows=manifest.stage.get('posterior_chunk_rows', 256),
+                          float32=manifest.stage.get('posterior_float32', False))
+
+    def figures(self, tags=None, force=False):
+        """
+        Create the figures of the variants (only those of ``tags`` if
+        given) that have been added to the database. Figures whose
+        inputs have not changed are skipped, unless ``force=True``.
+        """
+
+        import HD72946B_models as models
+        import HD72946B_pipeline as pipeline
+
+        manifest = self.manifest
+        variants = self.variants(manifest, tags)
+
+        database = self.database
+
+        # Radtrans instances are shared across tags and jobs, up to this memory cap
+        models.RADTRANS_CACHE.max_bytes = manifest.figures.get('radtrans_cache_gb', 8.)*1e9
+
+        # Model spectra are memoized, optionally on disk such that a rerun reuses them
+        model_cache = self.model_cache(manifest.figures)
+
+        # Figures that only draw are rendered by render_workers processes
+        renderer = self.renderer(manifest.figures)
+
+        with contextlib.ExitStack() as stack:
+            if manifest.figures.get('rasterize', False):
+                stack.enter_context(render.rasterized_overlays(min_lines=manifest.figures.get('rasterize_min_lines', 20),
+                                                               dpi=manifest.figures.get('raster_dpi', 300)))
+
+            for variant in variants:
+                # Retrievals that are still running are only reported from their stream
+                if not pipeline.has_retrieval(database, variant.tag):
+                    pipeline.report_partial(variant)
+                    continue
+
+                self.jobs.run('figures', variant,
+                              pipeline.plot_variant, database, variant, manifest.figures,
+                              model_cache=model_cache, force=force, renderer=renderer)
+
+            renderer.wait()
+
+    def close(self):
+        """
+        Wait for the render workers that are still running.
+        """
+
+        if self._renderer is not None:
+            self._renderer.wait()
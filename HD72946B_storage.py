@@ -0,0 +1,162 @@
+################################################################################
+# Compact storage of the posterior samples in species_database.hdf5. The       #
+# samples that species.Database.add_retrieval writes are rewritten as a        #
+# chunked and compressed dataset (optionally float32), together with a         #
+# precomputed resampling index, such that a random subset of N samples only    #
+# reads the chunks that contain those N rows instead of the full posterior.    #
+# Subsets are cached per process, so the figures of a tag share one read.      #
+# The cache is keyed on a content id that is written with the samples.         #
+################################################################################
+import functools
+import hashlib
+import uuid
+
+import h5py
+import numpy as np
+
+# Datasets of results/fit/<tag> with one row per posterior sample
+SAMPLE_DATASETS = ('samples', 'ln_prob')
+
+# Attribute of results/fit/<tag> that changes whenever the samples are written
+CONTENT_ID = 'content_id'
+
+
+def mark_posterior(database_path, tag):
+    """
+    Store a new content id for the posterior of ``tag``, after its
+    samples have been written (e.g. by ``species.Database.add_retrieval``).
+    Returns the id.
+    """
+
+    with h5py.File(database_path, 'a') as h5_file:
+        content_id = uuid.uuid4().hex
+        h5_file[f'results/fit/{tag}'].attrs[CONTENT_ID] = content_id
+
+    _read_subset.cache_clear()
+
+    return content_id
+
+
+def content_id(database_path, tag):
+    """
+    Content id of the posterior of ``tag``, which identifies the samples
+    without reading them. A posterior that was added without an id (e.g.
+    by an older version of the pipeline) is identified by the SHA-1 of
+    its samples and resampling index instead.
+    """
+
+    with h5py.File(database_path, 'r') as h5_file:
+        group = h5_file[f'results/fit/{tag}']
+
+        if CONTENT_ID in group.attrs:
+            return str(group.attrs[CONTENT_ID])
+
+        sha1 = hashlib.sha1()
+
+        for item in ('samples', 'resample_index'):
+            if item in group:
+                sha1.update(np.ascontiguousarray(group[item]).tobytes())
+
+    return sha1.hexdigest()
+
+
+def is_compact(database_path, tag, chunk_rows=256, float32=False):
+    """
+    Check if the posterior of ``tag`` is stored with these settings.
+    """
+
+    with h5py.File(database_path, 'r') as h5_file:
+        group = h5_file[f'results/fit/{tag}']
+        dset = group['samples']
+
+        return 'resample_index' in group and dset.chunks is not None and \
+            dset.chunks[0] == min(chunk_rows, dset.shape[0]) and \
+            (dset.dtype == np.float32) == float32
+
+
+def compact_posterior(database_path, tag, chunk_rows=256, float32=False, compression='gzip', seed=0):
+    """
+    Rewrite the posterior datasets of ``tag`` with chunks of
+    ``chunk_rows`` rows and ``compression`` (with the shuffle filter),
+    and store a resampling index. The samples of species have equal
+    weights, so the index is a random permutation and the first N
+    entries are a random subset of N samples (without replacement).
+    With ``float32``, the samples are stored in single precision. The
+    attributes are kept. HDF5 does not reuse the space of the replaced
+    datasets, so run ``h5repack`` to shrink an existing database.
+    """
+
+    if is_compact(database_path, tag, chunk_rows=chunk_rows, float32=float32):
+        return
+
+    with h5py.File(database_path, 'a') as h5_file:
+        group = h5_file[f'results/fit/{tag}']
+
+        for name in SAMPLE_DATASETS:
+            if name not in group:
+                continue
+
+            data = np.asarray(group[name])
+            attrs = dict(group[name].attrs)
+
+            if float32 and name == 'samples':
+                data = data.astype(np.float32)
+
+            del group[name]
+
+            dset = group.create_dataset(name, data=data,
+                                        chunks=(min(chunk_rows, data.shape[0]),)+data.shape[1:],
+                                        compression=compression, shuffle=True)
+
+            dset.attrs.update(attrs)
+
+        if 'resample_index' in group:
+            del group['resample_index']
+
+        rng = np.random.default_rng(seed)
+        index = group.create_dataset('resample_index', data=rng.permutation(group['samples'].shape[0]))
+        index.attrs['seed'] = seed
+
+    mark_posterior(database_path, tag)
+
+
+@functools.lru_cache(maxsize=32)
+def _read_subset(database_path, tag, random, version):
+    with h5py.File(database_path, 'r') as h5_file:
+        group = h5_file[f'results/fit/{tag}']
+        dset = group['samples']
+
+        if random is None:
+            return np.asarray(dset)
+
+        if 'resample_index' in group and random <= dset.shape[0]:
+            # h5py requires increasing indices, so the subset is read in
+            # sorted order and then put back in the order of the index
+            index = np.asarray(group['resample_index'][:random])
+            order = np.argsort(index)
+
+            samples = np.empty((random,)+dset.shape[1:], dtype=dset.dtype)
+            samples[order] = dset[index[order], ...]
+
+            return samples
+
+        # Without an index, as species: random rows with replacement
+        samples = np.asarray(dset)
+
+    return samples[np.random.randint(samples.shape[0], size=random), :]
+
+
+def read_subset(database_path, tag, random=None):
+    """
+    All posterior samples of ``tag`` (``random=None``) or a random
+    subset of ``random`` samples from the resampling index. The result
+    is cached per process until the samples are rewritten (e.g. by
+    add_retrieval), which is detected with :func:`content_id`, so
+    repeated draws of the same size return the same samples. The
+    returned array is read-only.
+    """
+
+    samples = _read_subset(database_path, tag, random, content_id(database_path, tag))
+    samples.flags.writeable = False
+
+    return samples
@@ -0,0 +1,272 @@
+################################################################################
+# Incremental ingestion of running MultiNest retrievals. The dead points       #
+# (retrieval_ev.dat), live points (retrieval_phys_live.dat) and evidence       #
+# (retrieval_stats.dat) of a variant are followed while the sampler runs and   #
+# appended to chunked, resizable datasets in retrieval_stream.hdf5 in the      #
+# output folder. The file is written in HDF5 single-writer/multiple-reader     #
+# (SWMR) mode, so the figure stage can read the partial posterior safely. The  #
+# final result is still added to the species database with add_retrieval.      #
+################################################################################
+import json
+import os
+import warnings
+
+import h5py
+import numpy as np
+
+STREAM_FILE = 'retrieval_stream.hdf5'
+
+
+def stream_file(output_folder):
+    return os.path.join(output_folder, STREAM_FILE)
+
+
+class StreamIngester:
+    """
+    Follows the MultiNest output of one retrieval and appends new
+    rows to ``retrieval_stream.hdf5``. The datasets are created when
+    ``params.json`` is available (SWMR does not allow new objects
+    after the writer switched to SWMR mode), after which ``update``
+    can be called at any interval. Only complete lines are read, so
+    a file that is being written by MultiNest is never parsed halfway.
+    """
+
+    def __init__(self, output_folder, chunk_size=1024):
+        self.output_folder = output_folder
+        self.filename = stream_file(output_folder)
+        self.chunk_size = chunk_size
+
+        self.h5_file = None
+        self.offset = 0
+        self.mtime = {}
+
+    def _path(self, item):
+        return os.path.join(self.output_folder, 'retrieval_'+item)
+
+    def _changed(self, item):
+        if not os.path.exists(self._path(item)):
+            return False
+
+        mtime = os.path.getmtime(self._path(item))
+
+        if self.mtime.get(item) == mtime:
+            return False
+
+        self.mtime[item] = mtime
+
+        return True
+
+    def open(self):
+        """
+        Create the stream file and switch to SWMR mode. Returns ``False``
+        if the retrieval has not started yet.
+        """
+
+        if self.h5_file is not None:
+            return True
+
+        params_file = os.path.join(self.output_folder, 'params.json')
+
+        if not os.path.exists(params_file):
+            return False
+
+        with open(params_file, encoding='utf-8') as json_file:
+            parameters = json.load(json_file)
+
+        n_param = len(parameters)
+
+        # A resumed run writes the complete ev.dat again, so start from scratch
+        self.h5_file = h5py.File(self.filename, 'w', libver='latest')
+        self.h5_file.attrs['parameters'] = parameters
+
+        # Dead points: parameters, ln(L), ln(dX) with dX the prior mass of the shell
+        self.h5_file.create_dataset('dead', shape=(0, n_param+2), maxshape=(None, n_param+2),
+                                    chunks=(self.chunk_size, n_param+2), dtype='f8')
+
+        # Live points: parameters, ln(L)
+        self.h5_file.create_dataset('live', shape=(0, n_param+1), maxshape=(None, n_param+1),
+                                    chunks=(self.chunk_size, n_param+1), dtype='f8')
+
+        # Number of dead points, ln(Z) and its uncertainty at each dump of MultiNest
+        self.h5_file.create_dataset('evidence', shape=(0, 3), maxshape=(None, 3),
+                                    chunks=(self.chunk_size, 3), dtype='f8')
+
+        self.h5_file.swmr_mode = True
+
+        return True
+
+    def _read_lines(self):
+        # New complete lines of ev.dat since the previous update
+        if not os.path.exists(self._path('ev.dat')):
+            return np.zeros((0, 0))
+
+        with open(self._path('ev.dat'), 'rb') as ev_file:
+            ev_file.seek(self.offset)
+            data = ev_file.read()
+
+        end = data.rfind(b'\n')+1
+
+        if end == 0:
+            return np.zeros((0, 0))
+
+        self.offset += end
+
+        return np.atleast_2d(np.loadtxt(data[:end].decode().splitlines()))
+
+    @staticmethod
+    def _append(dataset, rows):
+        if rows.shape[0] == 0:
+            return
+
+        n_rows = dataset.shape[0]
+        dataset.resize(n_rows+rows.shape[0], axis=0)
+        dataset[n_rows:] = rows
+        dataset.flush()
+
+    def update(self):
+        """
+        Append the new dead points and evidence and replace the live
+        points. Returns the number of new dead points.
+        """
+
+        if not self.open():
+            return 0
+
+        dead = self.h5_file['dead']
+        n_col = dead.shape[1]
+
+        # Columns of ev.dat: parameters, ln(L), ln(dX), mode
+        rows = self._read_lines()
+
+        if rows.shape[0] > 0:
+            self._append(dead, rows[:, :n_col])
+
+        # Columns of phys_live.dat: parameters, ln(L), mode (live.dat is in the unit cube)
+        if self._changed('phys_live.dat'):
+            try:
+                live = np.loadtxt(self._path('phys_live.dat'), ndmin=2)[:, :n_col-1]
+
+            except ValueError:
+                # MultiNest is rewriting the file, so read it at the next update
+                del self.mtime['phys_live.dat']
+                live = np.asarray(self.h5_file['live'])
+
+            self.h5_file['live'].resize(live.shape[0], axis=0)
+            self.h5_file['live'][:] = live
+            self.h5_file['live'].flush()
+
+        if self._changed('stats.dat'):
+            with open(self._path('stats.dat'), encoding='utf-8') as stats_file:
+                for line in stats_file:
+                    if 'Global Log-Evidence' in line and 'Importance' not in line:
+                        values = line.split(':')[1].split('+/-')
+                        self._append(self.h5_file['evidence'],
+                                     np.array([[dead.shape[0], float(values[0]), float(values[1])]]))
+                        break
+
+        return rows.shape[0]
+
+    def close(self):
+        if self.h5_file is not None:
+            self.update()
+            self.h5_file.close()
+            self.h5_file = None
+
+            check_final(self.output_folder)
+
+
+def read_stream(output_folder):
+    """
+    Read the (partial) MultiNest output of a retrieval from its stream
+    file. The file is opened in SWMR read mode, so this is safe while
+    the ingester is appending. Returns ``None`` if there is no stream.
+    """
+
+    if not os.path.exists(stream_file(output_folder)):
+        return None
+
+    with h5py.File(stream_file(output_folder), 'r', libver='latest', swmr=True) as h5_file:
+        stream = {'parameters': list(h5_file.attrs['parameters'])}
+
+        for item in ('dead', 'live', 'evidence'):
+            h5_file[item].refresh()
+            stream[item] = np.asarray(h5_file[item])
+
+    return stream
+
+
+def partial_posterior(stream):
+    """
+    Weighted posterior samples from the dead and live points of a
+    stream, with weights L*dX/Z. The prior mass dX of each dead point
+    is stored by MultiNest, and the live points share the remaining
+    prior volume, which is estimated from the shrinkage of the last
+    shell. Returns the samples, the weights and ln(Z) of the points
+    that have been sampled so far.
+    """
+
+    dead, live = stream['dead'], stream['live']
+    n_param = len(stream['parameters'])
+    n_live = max(live.shape[0], 1)
+
+    ln_dx = dead[:, -1]
+
+    # Each shell shrinks the volume by exp(-1/n_live), so the shell of
+    # the last dead point is X*(exp(1/n_live)-1) with X what remains
+    if dead.shape[0] > 0:
+        ln_x = ln_dx[-1]-np.log(np.expm1(1./n_live))
+    else:
+        ln_x = 0.
+
+    ln_w = np.concatenate([dead[:, n_param]+ln_dx,
+                           live[:, n_param]+ln_x-np.log(n_live)])
+
+    ln_z = np.logaddexp.reduce(ln_w)
+
+    samples = np.concatenate([dead[:, :n_param], live[:, :n_param]])
+
+    return samples, np.exp(ln_w-ln_z), ln_z
+
+
+def check_final(output_folder, max_shift=0.2, max_ln_z=0.5):
+    """
+    Compare the posterior of a completed retrieval from its stream
+    file with the equally weighted samples and the evidence of
+    MultiNest. A warning is raised if the mean of a parameter differs
+    by more than ``max_shift`` standard deviations or ln(Z) by more
+    than ``max_ln_z``. Returns the largest shift and the difference of
+    ln(Z), or ``None`` if the retrieval has not finished.
+    """
+
+    equal_file = os.path.join(output_folder, 'retrieval_post_equal_weights.dat')
+    stats_file = os.path.join(output_folder, 'retrieval_stats.dat')
+
+    stream = read_stream(output_folder)
+
+    if stream is None or stream['dead'].shape[0] == 0 or \
+            not os.path.exists(equal_file) or not os.path.exists(stats_file):
+        return None
+
+    n_param = len(stream['parameters'])
+
+    samples, weights, ln_z = partial_posterior(stream)
+    equal = np.loadtxt(equal_file, ndmin=2)[:, :n_param]
+
+    mean = np.sum(weights[:, np.newaxis]*samples, axis=0)
+    std = np.std(equal, axis=0)
+
+    shift = np.amax(np.abs(mean-np.mean(equal, axis=0))/np.where(std > 0., std, 1.))
+
+    with open(stats_file, encoding='utf-8') as stats:
+        for line in stats:
+            if 'Global Log-Evidence' in line and 'Importance' not in line:
+                delta_ln_z = ln_z-float(line.split(':')[1].split('+/-')[0])
+                break
+        else:
+            delta_ln_z = 0.
+
+    if shift > max_shift or abs(delta_ln_z) > max_ln_z:
+        warnings.warn(f'The streamed posterior of {output_folder} differs from the final MultiNest '
+                      f'output: the means differ by up to {shift:.2f} sigma and ln(Z) by {delta_ln_z:.2f}.')
+
+    return shift, delta_ln_z